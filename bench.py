@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# Copyright 2024 Marc-Antoine Ruel. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Benchmarks how effects scale with the number of LEDs.
+
+Each effect is compiled with optimizations at every requested number of LEDs
+then run headless on a virtual clock with --profile, several times. The lowest
+median update() cost of the runs is reported per frame and per LED, and
+optionally compared against a previous report.
+"""
+
+import argparse
+import csv
+import glob
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+import ellee
+
+FIELDS = ["file", "effect", "leds", "frames", "ns_per_frame", "ns_per_led", "p99_ns"]
+
+# The first one is update(), then rendering.
+NS_RE = re.compile(r"ns:\s+min (\d+) median (\d+) p99 (\d+) max (\d+)")
+
+def measure(exe):
+  """Runs exe and returns the (median, p99) of update() in ns, or None."""
+  proc = subprocess.run(
+      [exe], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+  m = NS_RE.search(proc.stderr)
+  if not m:
+    return None
+  return int(m.group(2)), int(m.group(3))
+
+def bench(esphome, cachedir, filename, leds, frames, runs):
+  """Returns the measurements of each effect in filename with leds LEDs.
+
+  Each effect is run runs times and the run with the lowest median is kept,
+  since noise only ever makes a run slower.
+  """
+  tmpdir = tempfile.mkdtemp(prefix="ellee")
+  try:
+    subprocess.check_output(
+        [sys.executable, os.path.join(THIS_DIR, "ellee.py"), filename,
+         "--esphome", esphome, "--cache-dir", cachedir, "--outdir", tmpdir,
+         "--num-leds", str(leds), "--frames", str(frames), "--as-binary",
+         "--profile", "--optimize"])
+    out = []
+    for effect in ellee.load_effects(filename, num_leds=leds):
+      # Run sequentially so the measurements do not interfere.
+      exe = ellee.effect_path(tmpdir, effect)
+      results = [r for r in (measure(exe) for _ in range(runs)) if r]
+      if not results:
+        # e.g. printf_then_exit.yaml.
+        print(f"  {effect.name}: no measurement, skipping", file=sys.stderr)
+        continue
+      median, p99 = min(results)
+      out.append({
+          "file": os.path.relpath(filename, THIS_DIR).replace(os.path.sep, "/"),
+          "effect": effect.name,
+          "leds": leds,
+          "frames": frames,
+          "ns_per_frame": median,
+          "ns_per_led": round(median / leds, 2),
+          "p99_ns": p99,
+      })
+    return out
+  finally:
+    shutil.rmtree(tmpdir)
+
+def load(path):
+  """Loads a report written by save()."""
+  with open(path, newline="") as f:
+    if path.endswith(".csv"):
+      rows = list(csv.DictReader(f))
+    else:
+      rows = json.load(f)
+  for r in rows:
+    for k in ("leds", "frames", "ns_per_frame", "p99_ns"):
+      r[k] = int(r[k])
+    r["ns_per_led"] = float(r["ns_per_led"])
+  return rows
+
+def save(path, rows):
+  """Writes the report as CSV if path ends with .csv, JSON otherwise."""
+  with open(path, "w", newline="") as f:
+    if path.endswith(".csv"):
+      w = csv.DictWriter(f, fieldnames=FIELDS)
+      w.writeheader()
+      w.writerows(rows)
+    else:
+      json.dump(rows, f, indent=2)
+      f.write("\n")
+
+def compare(baseline, rows, threshold):
+  """Prints the difference with the baseline and returns the regressions."""
+  key = lambda r: (r["file"], r["effect"], r["leds"])
+  old = {key(r): r for r in baseline}
+  regressions = []
+  for r in rows:
+    b = old.get(key(r))
+    if not b:
+      continue
+    delta = 100. * (r["ns_per_frame"] - b["ns_per_frame"]) / max(b["ns_per_frame"], 1)
+    mark = ""
+    if delta > threshold:
+      mark = "  REGRESSION"
+      regressions.append(r)
+    print(f"{r['effect']:<40} {r['leds']:>6} {b['ns_per_frame']:>12} -> {r['ns_per_frame']:>12} ns/frame {delta:+6.1f}%{mark}")
+  return regressions
+
+def main():
+  esphomekwargs = {"required": True}
+  if os.path.isfile(os.path.join(THIS_DIR, "..", "esphome", "esphome", "core", "color.cpp")):
+    esphomekwargs = {"default": os.path.join(THIS_DIR, "..", "esphome")}
+  parser = argparse.ArgumentParser(description=sys.modules[__name__].__doc__)
+  parser.add_argument(
+      "files", nargs="*", metavar="file.yaml",
+      help="esphome yaml files to benchmark; default: samples/*.yaml")
+  parser.add_argument(
+      "--esphome", metavar="path/to/esphome.git",
+      help="Path to esphome source code", **esphomekwargs)
+  parser.add_argument(
+      "--cache-dir", default=ellee.default_cache_dir(), metavar="path",
+      help="Directory to cache the compiled esphome support code")
+  parser.add_argument(
+      "--sizes", default="70,300,1000,5000", metavar="70,300",
+      help="Comma separated number of LEDs to benchmark; default: %(default)s")
+  parser.add_argument(
+      "--frames", type=int, default=1000, metavar="N",
+      help="Number of frames to render per run; default: %(default)s")
+  parser.add_argument(
+      "--runs", type=int, default=5, metavar="N",
+      help="Number of runs per effect, keeping the fastest; default: %(default)s")
+  parser.add_argument(
+      "-o", "--output", metavar="bench.json",
+      help="Write the report as JSON, or CSV if the name ends with .csv")
+  parser.add_argument(
+      "--baseline", metavar="bench.json",
+      help="Compare against a previous report and fail on regressions")
+  parser.add_argument(
+      "--threshold", type=float, default=10., metavar="PCT",
+      help="Slowdown in percent considered a regression; default: %(default)s")
+  args = parser.parse_args()
+  files = args.files or sorted(glob.glob(os.path.join(THIS_DIR, "samples", "*.yaml")))
+  sizes = [int(s) for s in args.sizes.split(",")]
+  rows = []
+  for filename in files:
+    for leds in sizes:
+      print(f"{filename} with {leds} LEDs", file=sys.stderr)
+      try:
+        rows.extend(bench(args.esphome, args.cache_dir, filename, leds, args.frames, args.runs))
+      except subprocess.CalledProcessError as e:
+        print("Failed:", e, file=sys.stderr)
+        return 1
+  for r in rows:
+    print(f"{r['effect']:<40} {r['leds']:>6} {r['ns_per_frame']:>12} ns/frame {r['ns_per_led']:>10.2f} ns/LED")
+  if args.output:
+    save(args.output, rows)
+  if args.baseline:
+    if compare(load(args.baseline), rows, args.threshold):
+      return 1
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -6,21 +6,37 @@
 """Runs a display effect locally for faster iteration."""
 
 import argparse
+import collections
+import hashlib
 import os
 import shutil
+import struct
 import subprocess
 import sys
+import tempfile
 import textwrap
 import threading
+import time
+import zlib
 
 import yaml
 
 HEADER = r"""// Generated by ellee.py
 
 #include "esphome/components/light/addressable_light_effect.h"
+#include <algorithm>
+#include <chrono>
+#include <csignal>
+#include <string>
+#include <vector>
 #ifdef _WIN32
 #define WIN32_LEAN_AND_MEAN
 #include <windows.h>
+#include <fcntl.h>
+#include <io.h>
+#else
+#include <sys/ioctl.h>
+#include <unistd.h>
 #endif
 
 using namespace esphome;
@@ -29,6 +45,15 @@ using namespace esphome;
 #ifndef M_PIf
 #define M_PIf        3.14159265358979323846f
 #endif
+
+// Draws the whole next frame, to be called after writing to the terminal.
+void redraw();
+"""
+
+# Precompiled header shared by all effects.
+PCH = """// Generated by ellee.py
+
+#include "esphome/components/light/addressable_light_effect.h"
 """
 
 PREAMBLE = """
@@ -37,16 +62,251 @@ void update(esphome::light::AddressableLight &it, bool initial_run) {
   // Beginning of lambda.
 """
 
-FOOTER = r"""
+LAMBDA_END = """
   // End of lambda.
 }
+"""
+
+# Replaces the lambda in the --watch host executable.
+WATCH_HOST = r"""
+// Hot reload support for --watch. The effect is loaded from the shared object
+// whose path is written on stdin by ellee.py.
+#include <dlfcn.h>
+#include <poll.h>
+#include <unistd.h>
+
+void *g_effect = nullptr;
+void (*g_update)(esphome::light::AddressableLight &, bool) = nullptr;
+
+bool reload_effect() {
+  struct pollfd p = {0, POLLIN, 0};
+  if (poll(&p, 1, 0) <= 0) {
+    return false;
+  }
+  char buf[4096];
+  ssize_t n = read(0, buf, sizeof(buf)-1);
+  if (n <= 0) {
+    // ellee.py went away.
+    exit(0);
+  }
+  // ellee.py printed a message, and so may dlerror() below.
+  redraw();
+  // Only keep the last line.
+  while (n && buf[n-1] == '\n') {
+    n--;
+  }
+  buf[n] = 0;
+  char *path = strrchr(buf, '\n');
+  path = path ? path+1 : buf;
+  if (!*path) {
+    // Only a redraw was requested.
+    return false;
+  }
+  void *handle = dlopen(path, RTLD_NOW | RTLD_LOCAL);
+  if (!handle) {
+    fprintf(stderr, "\n%s\n", dlerror());
+    return false;
+  }
+  auto f = (decltype(g_update))dlsym(handle, "ellee_update");
+  if (!f) {
+    fprintf(stderr, "\n%s\n", dlerror());
+    dlclose(handle);
+    return false;
+  }
+  if (g_effect) {
+    dlclose(g_effect);
+  }
+  g_effect = handle;
+  g_update = f;
+  return true;
+}
 
+void update(esphome::light::AddressableLight &it, bool initial_run) {
+  if (reload_effect()) {
+    // Like when switching effect on the device.
+    it.clear_effect_data();
+    initial_run = true;
+  }
+  if (g_update) {
+    g_update(it, initial_run);
+  }
+}
+"""
+
+# Followed by the body of the esphome pixel_mapper lambda.
+PIXEL_MAP = """
+// Returns the index of the LED at x, y in the matrix.
+int pixel_map(int x, int y) {
+"""
+
+# Appended to the lambda in the --watch shared object.
+WATCH_EFFECT = r"""
+extern "C" __attribute__((visibility("default")))
+void ellee_update(esphome::light::AddressableLight &it, bool initial_run) {
+  update(it, initial_run);
+}
+"""
+
+# Written after the effects of a --combined executable, followed by the
+# EFFECTS table.
+COMBINED = r"""
+// Effects built in this executable, selected at runtime.
+struct EffectInfo {
+  const char *name;
+  void (*update)(esphome::light::AddressableLight &, bool);
+  int (*pixel_map)(int, int);
+  int frames;
+  int interval;
+  int matrix_height;
+  int matrix_width;
+  int numlights;
+  bool serpentine;
+};
+
+"""
+
+COMBINED_SELECT = r"""const int NUM_EFFECTS = sizeof(EFFECTS)/sizeof(EFFECTS[0]);
+int g_effect = 0;
+// Time in ms to show each effect with --cycle, 0 to stay on one effect.
+uint32_t g_cycle = 0;
+uint32_t g_effect_start = 0;
+int g_argc = 0;
+char **g_argv = nullptr;
+
+#ifndef _WIN32
+// esphome's main() does not forward the arguments but the C runtime passes
+// them to the constructors.
+__attribute__((constructor)) void save_args(int argc, char **argv) {
+  g_argc = argc;
+  g_argv = argv;
+}
+#endif
+
+void parse_args();
+void update(esphome::light::AddressableLight &it, bool initial_run);
+
+int pixel_map(int x, int y) {
+  return EFFECTS[g_effect].pixel_map(x, y);
+}
+"""
+
+# Appended to a --combined executable.
+COMBINED_MAIN = r"""
+// Switches to an effect like the effect selector of the device.
+void select_effect(int i) {
+  const EffectInfo &e = EFFECTS[i];
+  if (!g_initial_run && !AS_BINARY && !ONE_PER_LINE) {
+    // Keep the last frame of the previous effect.
+    printf("\n");
+    fflush(stdout);
+  }
+  if (g_cycle) {
+    fprintf(stderr, "%s\n", e.name);
+  }
+  g_effect = i;
+  INTERVAL = e.interval;
+  MATRIX_HEIGHT = e.matrix_height;
+  MATRIX_WIDTH = e.matrix_width;
+  NUMLIGHTS = e.numlights;
+  SERPENTINE = e.serpentine;
+  it.resize(e.numlights);
+  g_initial_run = true;
+  g_effect_start = millis();
+}
+
+void update(esphome::light::AddressableLight &light, bool initial_run) {
+  if (g_cycle && millis() - g_effect_start >= g_cycle) {
+    select_effect((g_effect+1) % NUM_EFFECTS);
+    initial_run = true;
+  }
+  EFFECTS[g_effect].update(light, initial_run);
+}
+
+void usage(const char *arg0) {
+  fprintf(stderr, "usage: %s [--list] [--cycle SECONDS] [EFFECT]\n\n", arg0);
+  fprintf(stderr, "EFFECT is the name or the index of the effect to run; default: 0\n");
+  fprintf(stderr, "--cycle switches to the next effect every SECONDS\n");
+}
+
+void parse_args() {
+#ifdef _WIN32
+  g_argc = __argc;
+  g_argv = __argv;
+#endif
+  const char *arg0 = g_argc ? g_argv[0] : "ellee";
+  int selected = 0;
+  for (int i = 1; i < g_argc; i++) {
+    const char *arg = g_argv[i];
+    if (!strcmp(arg, "--list")) {
+      for (int j = 0; j < NUM_EFFECTS; j++) {
+        printf("%d: %s\n", j, EFFECTS[j].name);
+      }
+      exit(0);
+    } else if (!strcmp(arg, "--cycle") && i+1 < g_argc) {
+      g_cycle = uint32_t(atof(g_argv[++i])*1000);
+    } else if (!strcmp(arg, "-h") || !strcmp(arg, "--help")) {
+      usage(arg0);
+      exit(0);
+    } else {
+      char *end = nullptr;
+      selected = strtol(arg, &end, 10);
+      if (!*arg || *end) {
+        selected = -1;
+        for (int j = 0; j < NUM_EFFECTS; j++) {
+          if (!strcmp(arg, EFFECTS[j].name)) {
+            selected = j;
+            break;
+          }
+        }
+      }
+      if (selected < 0 || selected >= NUM_EFFECTS) {
+        fprintf(stderr, "unknown effect \"%s\"; use --list\n", arg);
+        exit(1);
+      }
+    }
+  }
+  // Allocate for the largest effect upfront so switching effect does not
+  // allocate.
+  int most = 0;
+  for (int j = 0; j < NUM_EFFECTS; j++) {
+    most = std::max(most, EFFECTS[j].numlights);
+    if (AS_BINARY && g_cycle &&
+        (EFFECTS[j].numlights != EFFECTS[0].numlights ||
+         EFFECTS[j].interval != EFFECTS[0].interval)) {
+      // The stream has a single header.
+      fprintf(stderr, "--cycle with --as-binary requires the same number of LEDs "
+              "and interval for all the effects\n");
+      exit(1);
+    }
+  }
+  it.resize(most);
+  select_effect(selected);
+  FRAMES = EFFECTS[selected].frames;
+}
+"""
+
+FOOTER = r"""
 // Support code.
 
 class ElleeLight : public esphome::light::AddressableLight {
   public:
     ElleeLight() {
       correction_.calculate_gamma_table(1);
+      resize(NUMLIGHTS);
+    }
+    // Changes the number of LEDs, turning them all off. It does not allocate
+    // when shrinking.
+    void resize(int n) {
+      pixels_.assign(3*n, 0);
+      effect_data_.assign(n, 0);
+      frame_.resize(4+3*n);
+      view_.clear();
+      drawn_.clear();
+    }
+    // Draws the whole next frame instead of only the LEDs that changed, since
+    // the cursor moved.
+    void redraw() {
+      drawn_.clear();
     }
     virtual esphome::light::LightTraits get_traits() {
       auto traits = esphome::light::LightTraits();
@@ -57,34 +317,220 @@ class ElleeLight : public esphome::light::AddressableLight {
       return NUMLIGHTS;
     }
     virtual void clear_effect_data() {
-      memset(effect_data_, 0, sizeof(effect_data_));
+      std::fill(effect_data_.begin(), effect_data_.end(), 0);
     }
     virtual esphome::light::ESPColorView get_view_internal(int32_t index) const {
       return esphome::light::ESPColorView(
           &pixels_[3*index], &pixels_[3*index+1], &pixels_[3*index+2],
-          nullptr, (uint8_t*)&effect_data_, &correction_);
+          nullptr, effect_data_.data(), &correction_);
     }
     virtual void write_state(esphome::light::LightState *state) {
-      if (AS_HEX) {
+      if (AS_BINARY) {
+        write_binary();
+      } else if (AS_HEX) {
         write_hex();
       } else {
         write_ansi();
       }
-      fflush(stdout);
+      if (PACED) {
+        fflush(stdout);
+      }
     }
+    // Builds the whole frame in ansi_ then writes it at once. The LEDs are
+    // averaged down to fit the terminal first.
     void write_ansi() {
-      printf("\r");
-      printf("\x1b[0m");
+      if (view_.empty()) {
+        init_view();
+      }
+      downsample();
+      if (MATRIX_HEIGHT) {
+        write_matrix();
+      } else {
+        write_strip();
+      }
+    }
+    // When the strip is redrawn on the same line, only the LEDs that changed
+    // are written.
+    void write_strip() {
+      const bool full = ONE_PER_LINE || drawn_.empty();
+      char *p = append(ansi_.data(), "\r\x1b[0m");
+      // Column of the first LED.
+      int offset = 1;
       if (SHOW_MILLIS) {
-        printf("%- 11d ", millis());
+        p += sprintf(p, "%- 11d ", millis());
+        offset += 12;
       }
-      for (int i = 0; i < size(); i++) {
-        printf("\x1b[38;2;%d;%d;%dm\u2588", pixels_[3*i], pixels_[3*i+1], pixels_[3*i+2]);
+      int cursor = 0;
+      uint32_t color = 0xFFFFFFFF;
+      for (int i = 0; i < view_width_; i++) {
+        const uint8_t *px = &view_[3*i];
+        if (!full && !memcmp(px, &drawn_[3*i], 3)) {
+          continue;
+        }
+        if (i != cursor) {
+          p = append(p, "\x1b[");
+          p = append_int(p, offset+i);
+          *p++ = 'G';
+        }
+        // Runs of the same color only need one escape sequence.
+        const uint32_t c = (px[0] << 16) | (px[1] << 8) | px[2];
+        if (c != color) {
+          p = append_color(p, 38, px);
+          color = c;
+        }
+        p = append(p, "\u2588");
+        cursor = i+1;
       }
-      printf("\x1b[0m ");
+      p = append(p, full ? "\x1b[0m " : "\x1b[0m");
       if (ONE_PER_LINE) {
-        printf("\n");
+        *p++ = '\n';
       }
+      fwrite(ansi_.data(), p-ansi_.data(), 1, stdout);
+      drawn_ = view_;
+    }
+    // Draws two rows of the matrix per line with the upper half block, the
+    // foreground being the top pixel and the background the bottom one.
+    void write_matrix() {
+      char *p = ansi_.data();
+      const int lines = (view_height_+1)/2 + (SHOW_MILLIS ? 1 : 0);
+      if (!ONE_PER_LINE && !drawn_.empty()) {
+        // Go back to the top of the previous frame.
+        p = append(p, "\x1b[");
+        p = append_int(p, lines);
+        *p++ = 'A';
+      }
+      p = append(p, "\r\x1b[0m");
+      if (SHOW_MILLIS) {
+        p += sprintf(p, "%- 11d\n", millis());
+      }
+      static const uint8_t black[3] = {};
+      for (int y = 0; y < view_height_; y += 2) {
+        uint32_t fg = 0xFFFFFFFF;
+        uint32_t bg = 0xFFFFFFFF;
+        for (int x = 0; x < view_width_; x++) {
+          const uint8_t *top = &view_[3*(y*view_width_+x)];
+          const uint8_t *bottom = y+1 < view_height_ ? &view_[3*((y+1)*view_width_+x)] : black;
+          const uint32_t t = (top[0] << 16) | (top[1] << 8) | top[2];
+          const uint32_t b = (bottom[0] << 16) | (bottom[1] << 8) | bottom[2];
+          if (t != fg) {
+            p = append_color(p, 38, top);
+            fg = t;
+          }
+          if (b != bg) {
+            p = append_color(p, 48, bottom);
+            bg = b;
+          }
+          p = append(p, "\u2580");
+        }
+        p = append(p, "\x1b[0m\n");
+      }
+      fwrite(ansi_.data(), p-ansi_.data(), 1, stdout);
+      drawn_ = view_;
+    }
+    // Sizes the view to the terminal and precomputes the LED of each pixel.
+    // Output that is not going to a terminal is not downsampled, unless
+    // COLUMNS is set.
+    void init_view() {
+      int columns = 80;
+      int rows = 24;
+#ifdef _WIN32
+      bool fit = _isatty(_fileno(stdout));
+      CONSOLE_SCREEN_BUFFER_INFO info;
+      if (GetConsoleScreenBufferInfo(GetStdHandle(STD_OUTPUT_HANDLE), &info)) {
+        columns = info.srWindow.Right - info.srWindow.Left + 1;
+        rows = info.srWindow.Bottom - info.srWindow.Top + 1;
+      }
+#else
+      bool fit = isatty(1);
+      struct winsize ws;
+      if (!ioctl(1, TIOCGWINSZ, &ws) && ws.ws_col && ws.ws_row) {
+        columns = ws.ws_col;
+        rows = ws.ws_row;
+      }
+#endif
+      if (const char *c = getenv("COLUMNS")) {
+        columns = std::max(atoi(c), 1);
+        fit = true;
+      }
+      width_ = MATRIX_HEIGHT ? MATRIX_WIDTH : NUMLIGHTS;
+      height_ = std::max(MATRIX_HEIGHT, 1);
+      if (!fit) {
+        scale_ = 1;
+      } else if (MATRIX_HEIGHT) {
+        // Keep the aspect ratio, two rows per line and one line for millis.
+        const int lines = std::max(rows - 1 - (SHOW_MILLIS ? 1 : 0), 1);
+        scale_ = std::max((width_+columns-1)/columns, (height_+2*lines-1)/(2*lines));
+      } else {
+        // Keep room for millis and the trailing space.
+        const int room = std::max(columns - 1 - (SHOW_MILLIS ? 12 : 0), 1);
+        scale_ = (width_+room-1)/room;
+      }
+      scale_ = std::max(scale_, 1);
+      view_width_ = (width_+scale_-1)/scale_;
+      view_height_ = (height_+scale_-1)/scale_;
+      view_.resize(3*view_width_*view_height_);
+      map_.resize(width_*height_);
+      for (int y = 0; y < height_; y++) {
+        for (int x = 0; x < width_; x++) {
+          map_[y*width_+x] = MATRIX_HEIGHT ? pixel_map(x, y) : x;
+        }
+      }
+      // Worst case per pixel: two colors and the block character.
+      ansi_.resize(64 + (view_width_*44+16)*(view_height_/2+2));
+    }
+    // Averages the LEDs covered by each pixel of the view.
+    void downsample() {
+      for (int vy = 0; vy < view_height_; vy++) {
+        for (int vx = 0; vx < view_width_; vx++) {
+          uint32_t sum[3] = {};
+          int n = 0;
+          for (int y = vy*scale_; y < std::min((vy+1)*scale_, height_); y++) {
+            for (int x = vx*scale_; x < std::min((vx+1)*scale_, width_); x++) {
+              const int i = map_[y*width_+x];
+              // Unmapped pixels are black.
+              if (i >= 0 && i < NUMLIGHTS) {
+                sum[0] += pixels_[3*i];
+                sum[1] += pixels_[3*i+1];
+                sum[2] += pixels_[3*i+2];
+              }
+              n++;
+            }
+          }
+          uint8_t *px = &view_[3*(vy*view_width_+vx)];
+          for (int c = 0; c < 3; c++) {
+            px[c] = sum[c]/n;
+          }
+        }
+      }
+    }
+    static char *append_color(char *p, int layer, const uint8_t *px) {
+      p = append(p, "\x1b[");
+      p = append_int(p, layer);
+      p = append(p, ";2;");
+      p = append_int(p, px[0]);
+      *p++ = ';';
+      p = append_int(p, px[1]);
+      *p++ = ';';
+      p = append_int(p, px[2]);
+      *p++ = 'm';
+      return p;
+    }
+    static char *append(char *p, const char *s) {
+      const size_t l = strlen(s);
+      memcpy(p, s, l);
+      return p+l;
+    }
+    static char *append_int(char *p, unsigned v) {
+      char tmp[10];
+      int n = 0;
+      do {
+        tmp[n++] = '0' + v%10;
+        v /= 10;
+      } while (v);
+      while (n) {
+        *p++ = tmp[--n];
+      }
+      return p;
     }
     void write_hex() {
       printf("\r");
@@ -101,134 +547,1470 @@ class ElleeLight : public esphome::light::AddressableLight {
         printf("\n");
       }
     }
+    // See FRAME_MAGIC in ellee.py for the format.
+    void write_binary() {
+      if (!header_written_) {
+        const uint16_t flags = SHOW_MILLIS ? 1 : 0;
+        uint8_t header[16] = {'E', 'L', 'L', 'E'};
+        put16(&header[4], FRAME_VERSION);
+        put16(&header[6], flags);
+        put32(&header[8], NUMLIGHTS);
+        put32(&header[12], INTERVAL);
+        fwrite(header, sizeof(header), 1, stdout);
+        header_written_ = true;
+      }
+      size_t offset = 0;
+      if (SHOW_MILLIS) {
+        put32(frame_.data(), millis());
+        offset = 4;
+      }
+      memcpy(&frame_[offset], pixels_.data(), pixels_.size());
+      fwrite(frame_.data(), offset + pixels_.size(), 1, stdout);
+    }
+    static void put16(uint8_t *dst, uint16_t v) {
+      dst[0] = v;
+      dst[1] = v >> 8;
+    }
+    static void put32(uint8_t *dst, uint32_t v) {
+      put16(dst, v);
+      put16(&dst[2], v >> 16);
+    }
+    static uint16_t get16(const uint8_t *src) {
+      return src[0] | (src[1] << 8);
+    }
+    static uint32_t get32(const uint8_t *src) {
+      return get16(src) | (uint32_t(get16(&src[2])) << 16);
+    }
+
+    mutable std::vector<uint8_t> pixels_;
+    mutable std::vector<uint8_t> effect_data_;
+    std::vector<uint8_t> frame_;
+    bool header_written_ = false;
+    // The terminal rendering state, set by init_view().
+    int width_ = 0;
+    int height_ = 0;
+    int scale_ = 1;
+    int view_width_ = 0;
+    int view_height_ = 0;
+    std::vector<int> map_;
+    std::vector<uint8_t> view_;
+    std::vector<uint8_t> drawn_;
+    std::vector<char> ansi_;
+};
+
+// Measures a step of each frame when PROFILE is set. When target is set, the
+// measurements are also projected to the MCU.
+class Profiler {
+  public:
+    Profiler(const char *name, bool target) : name_(name), target_(target) {
+    }
+    void start() {
+      start_ = std::chrono::steady_clock::now();
+    }
+    void stop() {
+      last_ = std::chrono::duration_cast<std::chrono::nanoseconds>(
+          std::chrono::steady_clock::now() - start_).count();
+    }
+    // Records the last measurement. It is separate from stop() since it
+    // allocates, which must not be seen by HeapTracker.
+    void commit() {
+      samples_.push_back(last_);
+    }
+    // Prints the statistics and clears the samples.
+    void report() {
+      if (samples_.empty()) {
+        return;
+      }
+      std::vector<uint64_t> sorted(samples_);
+      std::sort(sorted.begin(), sorted.end());
+      auto pct = [&](double p) {
+        return sorted[std::min(sorted.size()-1, size_t(p*sorted.size()))];
+      };
+      const uint64_t stats[] = {sorted.front(), pct(0.5), pct(0.99), sorted.back()};
+      fprintf(stderr, "\n%s over %zu frames:\n", name_, sorted.size());
+      fprintf(stderr, "  host:   min %.2fus  median %.2fus  p99 %.2fus  max %.2fus\n",
+              stats[0]/1e3, stats[1]/1e3, stats[2]/1e3, stats[3]/1e3);
+      // Exact values for tools like bench.py.
+      fprintf(stderr, "  ns:     min %llu median %llu p99 %llu max %llu\n",
+              (unsigned long long)stats[0], (unsigned long long)stats[1],
+              (unsigned long long)stats[2], (unsigned long long)stats[3]);
+      if (target_) {
+        fprintf(stderr, "  target: min %.0f  median %.0f  p99 %.0f  max %.0f cycles"
+                " (x%g slowdown at %dMHz)\n",
+                cycles(stats[0]), cycles(stats[1]), cycles(stats[2]), cycles(stats[3]),
+                MCU_SLOWDOWN, MCU_MHZ);
+      }
+      // Power of 2 microseconds buckets.
+      size_t buckets[33] = {};
+      size_t last = 0;
+      for (auto ns : samples_) {
+        size_t b = 0;
+        for (uint64_t us = ns/1000; us; us >>= 1) {
+          b++;
+        }
+        b = std::min(b, size_t(32));
+        buckets[b]++;
+        last = std::max(last, b);
+      }
+      const size_t most = *std::max_element(buckets, buckets+33);
+      for (size_t b = 0; b <= last; b++) {
+        fprintf(stderr, "  <%7lluus %7zu %s\n", b ? 1ULL << b : 1ULL, buckets[b],
+                std::string(buckets[b]*40/most, '#').c_str());
+      }
+      // Frames that would miss the update_interval.
+      const double factor = target_ ? MCU_SLOWDOWN : 1;
+      size_t over = 0;
+      for (size_t i = 0; i < samples_.size(); i++) {
+        if (samples_[i]*factor > INTERVAL*1e6) {
+          if (over < 10) {
+            fprintf(stderr, "  frame %zu took %.2fms on %s, over the %dms interval\n",
+                    i, samples_[i]*factor/1e6, target_ ? "target" : "host", INTERVAL);
+          }
+          over++;
+        }
+      }
+      if (over) {
+        fprintf(stderr, "  %zu frames over budget\n", over);
+      }
+      samples_.clear();
+    }
+
+  private:
+    static double cycles(uint64_t ns) {
+      return ns*MCU_SLOWDOWN*MCU_MHZ/1e3;
+    }
+
+    const char *const name_;
+    const bool target_;
+    std::chrono::steady_clock::time_point start_;
+    uint64_t last_ = 0;
+    std::vector<uint64_t> samples_;
+};
+
+// Counts the heap allocations done by update() when TRACK_HEAP is set. The
+// allocator hooks calling it are in HEAP_HOOKS.
+class HeapTracker {
+  public:
+    void on_alloc(size_t n) {
+      if (active_) {
+        frame_allocs_++;
+        frame_bytes_ += n;
+        live_ += n;
+        peak_ = std::max(peak_, live_);
+      }
+    }
+    void on_free(size_t n) {
+      if (active_) {
+        live_ -= n;
+      }
+    }
+    void begin() {
+      frame_allocs_ = 0;
+      frame_bytes_ = 0;
+      paint_stack();
+      active_ = true;
+    }
+    void end(bool initial_run) {
+      active_ = false;
+      stack_ = std::max(stack_, stack_used());
+      allocs_ += frame_allocs_;
+      bytes_ += frame_bytes_;
+      max_allocs_ = std::max(max_allocs_, frame_allocs_);
+      max_bytes_ = std::max(max_bytes_, frame_bytes_);
+      if (!initial_run && frame_allocs_) {
+        // Allocating in steady state fragments the heap on the device.
+        if (steady_ < 10) {
+          fprintf(stderr, "\nframe %zu allocated %zu bytes in %zu allocations\n",
+                  frames_, frame_bytes_, frame_allocs_);
+          redraw();
+        }
+        steady_++;
+      }
+      frames_++;
+    }
+    // Records the stack used by the profiler calls alone between begin() and
+    // this call. They run on the painted stack around update() so its usage
+    // can't be told apart when it is lower.
+    void calibrate() {
+      active_ = false;
+      profiler_stack_ = stack_used();
+    }
+    bool calibrated() const {
+      return profiler_stack_ != 0;
+    }
+    void report() const {
+      if (!frames_) {
+        return;
+      }
+      fprintf(stderr, "\nHeap usage of update() over %zu frames:\n", frames_);
+      fprintf(stderr, "  %.1f allocations and %.1f bytes per frame\n",
+              double(allocs_)/frames_, double(bytes_)/frames_);
+      fprintf(stderr, "  max %zu allocations and %zu bytes in a frame\n",
+              max_allocs_, max_bytes_);
+      fprintf(stderr, "  peak live heap %lld bytes, %lld bytes still live\n",
+              (long long)peak_, (long long)live_);
+      fprintf(stderr, "  %zu frames allocated after the initial run\n", steady_);
+      if (profiler_stack_ && stack_ <= profiler_stack_) {
+        fprintf(stderr, "  stack usage estimate at most %zu bytes on the host, "
+                "hidden by --profile\n", profiler_stack_);
+      } else {
+        fprintf(stderr, "  stack usage estimate %zu bytes on the host\n", stack_);
+      }
+    }
+
+  private:
+    static const size_t STACK_PAINT = 64*1024;
+    static const uint8_t STACK_MAGIC = 0xA5;
 
-    mutable uint8_t pixels_[3*NUMLIGHTS];
-    mutable uint8_t effect_data_[NUMLIGHTS];
+    // Fills the stack below the caller's frame with STACK_MAGIC, so
+    // stack_used() can find how deep update() went.
+    __attribute__((noinline)) void paint_stack() {
+      uint8_t buf[STACK_PAINT];
+      memset(buf, STACK_MAGIC, sizeof(buf));
+      asm volatile("" : : "r"(buf) : "memory");
+      stack_low_ = buf;
+    }
+    size_t stack_used() const {
+      size_t i = 0;
+      while (i < STACK_PAINT && stack_low_[i] == STACK_MAGIC) {
+        i++;
+      }
+      return STACK_PAINT - i;
+    }
+
+    bool active_ = false;
+    size_t frames_ = 0;
+    size_t frame_allocs_ = 0;
+    size_t frame_bytes_ = 0;
+    size_t allocs_ = 0;
+    size_t bytes_ = 0;
+    size_t max_allocs_ = 0;
+    size_t max_bytes_ = 0;
+    size_t steady_ = 0;
+    size_t stack_ = 0;
+    size_t profiler_stack_ = 0;
+    int64_t live_ = 0;
+    int64_t peak_ = 0;
+    volatile uint8_t *stack_low_ = nullptr;
 };
 
 ElleeLight it;
 bool g_initial_run = true;
+int g_frames = 0;
+Profiler g_profiler("update()", true);
+Profiler g_render("Rendering", false);
+HeapTracker g_heap;
+uint32_t g_next_frame = 0;
+size_t g_late_frames = 0;
+volatile sig_atomic_t g_signal = 0;
+// Time of the first frame, --seek and --checkpoint are relative to it.
+uint32_t g_start = 0;
+// Index of the next entry in CHECKPOINTS.
+size_t g_checkpoint = 0;
+
+void on_signal(int sig) {
+  g_signal = sig;
+}
+
+void redraw() {
+  it.redraw();
+}
+
+void report() {
+  if (PROFILE) {
+    g_profiler.report();
+    g_render.report();
+    if (g_late_frames) {
+      fprintf(stderr, "  %zu frames were late\n", g_late_frames);
+      g_late_frames = 0;
+    }
+  }
+  if (TRACK_HEAP) {
+    g_heap.report();
+  }
+}
+
+// Saves the LEDs, their effect data and the clock. See SNAPSHOT_MAGIC in
+// ellee.py for the format. The static locals of the lambda are not saved.
+bool save_snapshot(const char *path) {
+  FILE *f = fopen(path, "wb");
+  if (!f) {
+    perror(path);
+    return false;
+  }
+  uint8_t header[16] = {'E', 'L', 'S', 'N'};
+  ElleeLight::put16(&header[4], SNAPSHOT_VERSION);
+  ElleeLight::put16(&header[6], g_initial_run ? 1 : 0);
+  ElleeLight::put32(&header[8], NUMLIGHTS);
+  ElleeLight::put32(&header[12], millis());
+  bool ok = fwrite(header, sizeof(header), 1, f) == 1 &&
+            fwrite(it.pixels_.data(), it.pixels_.size(), 1, f) == 1 &&
+            fwrite(it.effect_data_.data(), it.effect_data_.size(), 1, f) == 1;
+  ok = !fclose(f) && ok;
+  if (!ok) {
+    fprintf(stderr, "\nfailed to write %s\n", path);
+  }
+  return ok;
+}
+
+// Restores the state saved by save_snapshot(). The animation continues from
+// the frame following the snapshot.
+bool load_snapshot(const char *path) {
+  FILE *f = fopen(path, "rb");
+  if (!f) {
+    perror(path);
+    return false;
+  }
+  uint8_t header[16];
+  bool ok = fread(header, sizeof(header), 1, f) == 1 && !memcmp(header, "ELSN", 4) &&
+            ElleeLight::get16(&header[4]) == SNAPSHOT_VERSION;
+  if (ok && ElleeLight::get32(&header[8]) != uint32_t(NUMLIGHTS)) {
+    fprintf(stderr, "%s has %u LEDs instead of %d\n",
+            path, ElleeLight::get32(&header[8]), NUMLIGHTS);
+    fclose(f);
+    return false;
+  }
+  ok = ok && fread(it.pixels_.data(), it.pixels_.size(), 1, f) == 1 &&
+       fread(it.effect_data_.data(), it.effect_data_.size(), 1, f) == 1;
+  fclose(f);
+  if (!ok) {
+    fprintf(stderr, "%s is not a valid snapshot\n", path);
+    return false;
+  }
+  g_initial_run = ElleeLight::get16(&header[6]) & 1;
+  g_virtual_millis = ElleeLight::get32(&header[12]);
+  // Skip the checkpoints up to the snapshot, which already exist.
+  while (millis() - g_start >= CHECKPOINTS[g_checkpoint]) {
+    g_checkpoint++;
+  }
+  return true;
+}
 
 void setup() {
+  if (getenv("ELLEE_PIXEL_MAP")) {
+    // Used by ellee.py --export to lay out the LEDs; one row per line.
+    for (int y = 0; y < std::max(MATRIX_HEIGHT, 1); y++) {
+      for (int x = 0; x < (MATRIX_HEIGHT ? MATRIX_WIDTH : NUMLIGHTS); x++) {
+        printf("%d ", MATRIX_HEIGHT ? pixel_map(x, y) : x);
+      }
+      printf("\n");
+    }
+    exit(0);
+  }
+  g_next_frame = (esphome::millis)();
+  g_start = millis();
+  if (VIRTUAL_CLOCK) {
+    // Set by render.py to render a slice of the animation.
+    if (const char *offset = getenv("ELLEE_OFFSET")) {
+      g_virtual_millis += strtoul(offset, nullptr, 10);
+    }
+  }
+  if (PROFILE || TRACK_HEAP) {
+    // Print the report on exit, including Ctrl-C, or on demand with SIGUSR1.
+    atexit(report);
+    signal(SIGINT, on_signal);
+    signal(SIGTERM, on_signal);
+#ifdef SIGUSR1
+    signal(SIGUSR1, on_signal);
+#endif
+  }
 """
 
 END = r"""}
 
 void loop() {
+  const uint32_t elapsed = millis() - g_start;
+  if (elapsed >= CHECKPOINTS[g_checkpoint]) {
+    // Save the state before computing the frame. It is named after the time
+    // of the frame, which is later than the checkpoint when the interval does
+    // not divide it.
+    char path[4096];
+    snprintf(path, sizeof(path), "%s.%u.snap", CHECKPOINT_PREFIX, elapsed);
+    if (save_snapshot(path)) {
+      fprintf(stderr, "\nsaved %s\n", path);
+    }
+    redraw();
+    // Only one snapshot when the interval spans multiple checkpoints.
+    while (elapsed >= CHECKPOINTS[g_checkpoint]) {
+      g_checkpoint++;
+    }
+  }
+  if (TRACK_HEAP && PROFILE && !g_heap.calibrated()) {
+    // The first calls resolve the clock functions, which uses more stack.
+    g_profiler.start();
+    g_profiler.stop();
+    g_heap.begin();
+    g_profiler.start();
+    g_profiler.stop();
+    g_heap.calibrate();
+  }
+  if (TRACK_HEAP) {
+    g_heap.begin();
+  }
+  if (PROFILE) {
+    g_profiler.start();
+  }
   update(it, g_initial_run);
+  if (PROFILE) {
+    g_profiler.stop();
+  }
+  if (TRACK_HEAP) {
+    g_heap.end(g_initial_run);
+  }
+  if (PROFILE) {
+    g_profiler.commit();
+  }
+  if (g_signal) {
+    if (g_signal == SIGINT || g_signal == SIGTERM) {
+      exit(0);
+    }
+    report();
+    redraw();
+    g_signal = 0;
+  }
   g_initial_run = false;
-  it.write_state(nullptr);
-  if (ONCE) {
-    printf("\n");
-    fflush(stdout);
-    exit(0);
+  // The frames before --seek are computed but not rendered.
+  const bool seeking = elapsed < SEEK;
+  if (!seeking) {
+    if (PROFILE) {
+      g_render.start();
+    }
+    it.write_state(nullptr);
+    if (PROFILE) {
+      g_render.stop();
+      g_render.commit();
+    }
+    if (ONCE || (FRAMES && ++g_frames >= FRAMES)) {
+      if (!AS_BINARY) {
+        printf("\n");
+      }
+      fflush(stdout);
+      exit(0);
+    }
+  }
+  if (VIRTUAL_CLOCK) {
+    // Pretend the time passed.
+    g_virtual_millis += INTERVAL;
+  }
+  if (PACED && seeking) {
+    // Start pacing once the seek is done.
+    g_next_frame = (esphome::millis)();
+  } else if (PACED) {
+    // Sleep until the next frame is due, so the cost of update() and
+    // rendering does not slow down the animation.
+    g_next_frame += INTERVAL;
+    // The parenthesis bypass the virtual clock macro.
+    const uint32_t now = (esphome::millis)();
+    if (int32_t(g_next_frame - now) > 0) {
+      esphome::delay(g_next_frame - now);
+    } else {
+      // Do not try to catch up.
+      g_late_frames++;
+      g_next_frame = now;
+    }
   }
-  esphome::delay(INTERVAL);
 }
 """
 
+# Appended with --track-heap to route the allocations to g_heap.
+HEAP_HOOKS = r"""
+// Heap tracking hooks.
+#ifdef __GLIBC__
+// Interpose the C allocator; operator new uses it.
+#include <malloc.h>
+
+extern "C" {
+
+void *__libc_malloc(size_t);
+void *__libc_calloc(size_t, size_t);
+void *__libc_realloc(void *, size_t);
+void __libc_free(void *);
+
+void *malloc(size_t n) __THROW {
+  void *p = __libc_malloc(n);
+  if (p) {
+    g_heap.on_alloc(malloc_usable_size(p));
+  }
+  return p;
+}
+
+void *calloc(size_t n, size_t size) __THROW {
+  void *p = __libc_calloc(n, size);
+  if (p) {
+    g_heap.on_alloc(malloc_usable_size(p));
+  }
+  return p;
+}
+
+void *realloc(void *p, size_t n) __THROW {
+  const size_t old = p ? malloc_usable_size(p) : 0;
+  void *q = __libc_realloc(p, n);
+  if (q || !n) {
+    if (p) {
+      g_heap.on_free(old);
+    }
+    if (q) {
+      g_heap.on_alloc(malloc_usable_size(q));
+    }
+  }
+  return q;
+}
+
+void free(void *p) __THROW {
+  if (p) {
+    g_heap.on_free(malloc_usable_size(p));
+  }
+  __libc_free(p);
+}
+
+}  // extern "C"
+#else
+// Only operator new and delete can be replaced portably. The size is stored
+// in front of the block.
+#include <cstddef>
+#include <new>
+
+const size_t HEAP_HEADER = alignof(std::max_align_t);
+
+void *heap_alloc(size_t n) {
+  auto p = static_cast<uint8_t *>(malloc(n + HEAP_HEADER));
+  if (!p) {
+    return nullptr;
+  }
+  *reinterpret_cast<size_t *>(p) = n;
+  g_heap.on_alloc(n);
+  return p + HEAP_HEADER;
+}
+
+void heap_free(void *p) {
+  if (p) {
+    auto b = static_cast<uint8_t *>(p) - HEAP_HEADER;
+    g_heap.on_free(*reinterpret_cast<size_t *>(b));
+    free(b);
+  }
+}
+
+void *operator new(size_t n) {
+  if (void *p = heap_alloc(n)) {
+    return p;
+  }
+  throw std::bad_alloc();
+}
+void *operator new[](size_t n) {
+  return operator new(n);
+}
+void *operator new(size_t n, const std::nothrow_t &) noexcept {
+  return heap_alloc(n);
+}
+void *operator new[](size_t n, const std::nothrow_t &) noexcept {
+  return heap_alloc(n);
+}
+void operator delete(void *p) noexcept {
+  heap_free(p);
+}
+void operator delete[](void *p) noexcept {
+  heap_free(p);
+}
+void operator delete(void *p, size_t) noexcept {
+  heap_free(p);
+}
+void operator delete[](void *p, size_t) noexcept {
+  heap_free(p);
+}
+void operator delete(void *p, const std::nothrow_t &) noexcept {
+  heap_free(p);
+}
+void operator delete[](void *p, const std::nothrow_t &) noexcept {
+  heap_free(p);
+}
+#endif
+"""
+
+# Binary frame stream emitted with --as-binary. All integers are little endian.
+#
+# Header (16 bytes):
+#   magic "ELLE", uint16 version, uint16 flags, uint32 numlights,
+#   uint32 interval in ms.
+# Then for each frame:
+#   uint32 millis if flags & FRAME_FLAG_MILLIS, then numlights RGB triplets.
+FRAME_MAGIC = b"ELLE"
+FRAME_VERSION = 1
+FRAME_FLAG_MILLIS = 1
+FRAME_HEADER_SIZE = 16
+
+def parse_frame_header(header):
+  """Returns the FrameHeader of the first FRAME_HEADER_SIZE bytes of a binary
+  frame stream.
+
+  Raises ValueError if it is not a supported frame stream.
+  """
+  if len(header) != FRAME_HEADER_SIZE or header[:4] != FRAME_MAGIC:
+    raise ValueError("not an ellee frame stream")
+  version, flags, numlights, interval = struct.unpack("<HHII", header[4:])
+  if version != FRAME_VERSION:
+    raise ValueError(f"unsupported frame stream version {version}")
+  millis = bool(flags & FRAME_FLAG_MILLIS)
+  return FrameHeader(millis, numlights, interval, (4 if millis else 0) + 3*numlights)
+
+# Snapshot saved with --checkpoint and loaded with --resume. All integers are
+# little endian.
+#
+# Header (16 bytes):
+#   magic "ELSN", uint16 version, uint16 flags (1 if the next frame is the
+#   initial run), uint32 numlights, uint32 millis of the next frame.
+# Then numlights RGB triplets and numlights bytes of effect data.
+SNAPSHOT_MAGIC = b"ELSN"
+SNAPSHOT_VERSION = 1
+
+Frames = collections.namedtuple("Frames", "numlights interval millis pixels")
+
+# Header of a binary frame stream. millis is True when each frame starts with
+# its time and size is the size of a frame in bytes.
+FrameHeader = collections.namedtuple("FrameHeader", "millis numlights interval size")
+
+# An addressable_lambda effect found in the yaml file. interval is the raw
+# update_interval string.
+Effect = collections.namedtuple(
+    "Effect", "component name numlights interval code layout")
+
+# The 2D arrangement of the LEDs of a light. mapper is the code of an esphome
+# pixel_mapper lambda returning the LED index at x, y, or None to map row by
+# row, reversing every other row if serpentine is set.
+Layout = collections.namedtuple("Layout", "width height serpentine mapper")
+
+# Compiled esphome support code. cflags must be used to compile an effect and
+# objs to link it.
+Support = collections.namedtuple("Support", "cflags objs")
+
+CXX = "g++"
+
+CXXFLAGS = ["-std=c++17", "-ggdb", "-DUSE_HOST", "-I."]
+# Added with --optimize, to measure performance.
+OPTIMIZE_FLAGS = ["-O2"]
+
+# esphome source files needed to link an effect. They are relative to the
+# esphome checkout.
+SUPPORT_FILES = [
+    "esphome/components/host/core.cpp",
+    "esphome/components/host/preferences.cpp",
+    "esphome/components/light/addressable_light.cpp",
+    "esphome/components/light/esp_color_correction.cpp",
+    "esphome/components/light/esp_hsv_color.cpp",
+    "esphome/components/light/esp_range_view.cpp",
+    "esphome/components/light/light_call.cpp",
+    "esphome/components/light/light_output.cpp",
+    "esphome/components/light/light_state.cpp",
+    "esphome/core/application.cpp",
+    "esphome/core/color.cpp",
+    "esphome/core/component.cpp",
+    "esphome/core/entity_base.cpp",
+    "esphome/core/helpers.cpp",
+    "esphome/core/scheduler.cpp",
+]
+
+# Directories whose content can affect the support objects. They are hashed to
+# key the cache.
+SUPPORT_DIRS = sorted(set(os.path.dirname(f) for f in SUPPORT_FILES))
+
+def default_cache_dir():
+  if sys.platform == "win32":
+    base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+  elif sys.platform == "darwin":
+    base = os.path.expanduser(os.path.join("~", "Library", "Caches"))
+  else:
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser(os.path.join("~", ".cache"))
+  return os.path.join(base, "ellee")
+
+def support_key(esphome, flags):
+  """Returns the cache key for the support objects.
+
+  It covers the compiler version, the flags, the esphome sources and headers
+  and the local defines.h override.
+  """
+  h = hashlib.sha256()
+  h.update(subprocess.check_output([CXX, "--version"]))
+  h.update("\0".join(flags).encode())
+  paths = [os.path.join("esphome", "core", "defines.h")]
+  for d in SUPPORT_DIRS:
+    root = os.path.join(esphome, d)
+    for dirpath, dirnames, filenames in os.walk(root):
+      dirnames.sort()
+      paths.extend(
+          os.path.join(dirpath, f) for f in sorted(filenames)
+          if f.endswith((".h", ".cpp")))
+  for p in paths:
+    if not os.path.isfile(p):
+      continue
+    h.update(p.replace(os.path.sep, "/").encode() + b"\0")
+    with open(p, "rb") as f:
+      h.update(hashlib.sha256(f.read()).digest())
+  return h.hexdigest()[:16]
+
+class Job:
+  """A unit of work run by the Scheduler.
+
+  cost is an estimate of the relative duration of the job, used to start the
+  longest jobs first.
+  """
+  def __init__(self, name, target, args, cost=0):
+    self.name = name
+    self.target = target
+    self.args = args
+    self.cost = cost
+    self.duration = None
+    self.error = None
+
+  def run(self):
+    start = time.monotonic()
+    try:
+      if self.target(*self.args) is False:
+        self.error = "failed"
+    except (OSError, ValueError, subprocess.CalledProcessError) as e:
+      self.error = str(e)
+    except Exception as e:
+      # A bug in the job must not kill the worker thread.
+      self.error = f"{type(e).__name__}: {e}"
+    self.duration = time.monotonic() - start
+    return not self.error
+
+class Scheduler:
+  """Runs jobs on a bounded number of worker threads.
+
+  Each g++ process is heavy, so starting one per effect thrashes the machine
+  on large configurations.
+  """
+  def __init__(self, jobs, order="fifo"):
+    self.jobs = max(1, jobs)
+    self.order = order
+    self.failures = []
+    self._lock = threading.Lock()
+
+  def run(self, jobs):
+    """Runs all the jobs and returns True if they all succeeded."""
+    pending = list(jobs)
+    if self.order == "longest":
+      pending.sort(key=lambda j: j.cost, reverse=True)
+    total = len(pending)
+    done = []
+    start = time.monotonic()
+    def worker():
+      while True:
+        with self._lock:
+          if not pending:
+            return
+          job = pending.pop(0)
+        job.run()
+        with self._lock:
+          done.append(job)
+          status = "done" if not job.error else "FAILED"
+          print(f"[{len(done)}/{total}] {job.name}: {status} in {job.duration:.2f}s")
+    threads = [
+        threading.Thread(target=worker) for _ in range(min(self.jobs, total))
+    ]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    failed = [j for j in done if j.error]
+    self.failures.extend(failed)
+    if total > 1:
+      busy = sum(j.duration for j in done)
+      print(
+          f"{total} jobs in {time.monotonic() - start:.2f}s "
+          f"({busy:.2f}s busy, {self.jobs} workers), {len(failed)} failed")
+    for j in failed:
+      print(f"  {j.name}: {j.error}", file=sys.stderr)
+    return not failed
+
+def compile_object(esphome, src, obj, flags):
+  subprocess.check_call(
+      [CXX] + flags + ["-c", "-o", obj, "-I" + esphome, os.path.join(esphome, src)])
+
+def compile_pch(esphome, header, flags):
+  with open(header, "wt") as f:
+    f.write(PCH)
+  subprocess.check_call(
+      [CXX] + flags + ["-x", "c++-header", "-o", header + ".gch", "-I" + esphome, header])
+
+def build_support(esphome, cachedir, scheduler, optimize=False):
+  """Compiles the esphome support files and a precompiled header once.
+
+  Returns the Support to build an effect against the cached support code, or
+  None on failure. With optimize, everything is built with OPTIMIZE_FLAGS.
+  """
+  extra = OPTIMIZE_FLAGS if optimize else []
+  flags = CXXFLAGS + extra
+  outdir = os.path.join(cachedir, "support-" + support_key(esphome, flags))
+  objs = [
+      os.path.join(outdir, os.path.splitext(f)[0].replace("/", "_") + ".o")
+      for f in SUPPORT_FILES
+  ]
+  pch = os.path.join(outdir, "ellee_pch.h")
+  # The effect must be built with the same flags to use the precompiled header.
+  support = Support(extra + ["-include", pch], objs)
+  if all(os.path.isfile(o) for o in objs + [pch + ".gch"]):
+    return support
+  print(f"Compiling esphome support code to {outdir}")
+  os.makedirs(cachedir, exist_ok=True)
+  # Build in a temporary directory then rename it, so concurrent ellee
+  # processes never see a partial cache entry.
+  tmpdir = tempfile.mkdtemp(prefix="support-", dir=cachedir)
+  try:
+    jobs = [
+        Job(os.path.basename(pch), compile_pch,
+            (esphome, os.path.join(tmpdir, os.path.basename(pch)), flags))
+    ]
+    for src, obj in zip(SUPPORT_FILES, objs):
+      jobs.append(Job(
+          src, compile_object,
+          (esphome, src, os.path.join(tmpdir, os.path.basename(obj)), flags),
+          os.path.getsize(os.path.join(esphome, src))))
+    if not scheduler.run(jobs):
+      return None
+    try:
+      os.rename(tmpdir, outdir)
+    except OSError:
+      # Another process won the race.
+      if not all(os.path.isfile(o) for o in objs):
+        raise
+  finally:
+    if os.path.isdir(tmpdir):
+      shutil.rmtree(tmpdir)
+  return support
+
+def parse_duration(value):
+  """Returns a duration like "100ms", "30s", "10min" or "24h" in milliseconds."""
+  if value.endswith("ms"):
+    return int(value[:-2])
+  if value.endswith("min"):
+    return int(value[:-3]) * 60000
+  if value.endswith("h"):
+    return int(value[:-1]) * 3600000
+  if value.endswith("s"):
+    return int(value[:-1]) * 1000
+  raise ValueError(f"Unknown duration {value}")
+
+def parse_matrix(value):
+  """Returns the (width, height) of a "WxH" matrix size."""
+  try:
+    width, height = (int(v) for v in value.lower().split("x"))
+  except ValueError:
+    raise argparse.ArgumentTypeError(f"invalid matrix size {value}, use WxH")
+  if width <= 0 or height <= 0:
+    raise argparse.ArgumentTypeError(f"invalid matrix size {value}")
+  return width, height
+
+def read_frames(path):
+  """Memory maps a binary frame stream generated with --as-binary.
+
+  Returns a Frames where pixels is a (frames, numlights, 3) uint8 numpy view
+  of the file and millis is a (frames,) view or None if the stream has no
+  timestamps. Nothing is copied. A truncated trailing frame is ignored.
+
+  Requires numpy.
+  """
+  import numpy
+  with open(path, "rb") as f:
+    try:
+      header = parse_frame_header(f.read(FRAME_HEADER_SIZE))
+    except ValueError as e:
+      raise ValueError(f"{path}: {e}")
+  fields = [("pixels", "u1", (header.numlights, 3))]
+  if header.millis:
+    fields.insert(0, ("millis", "<u4"))
+  dtype = numpy.dtype(fields)
+  count = (os.path.getsize(path) - FRAME_HEADER_SIZE) // dtype.itemsize
+  if count:
+    data = numpy.memmap(
+        path, dtype=dtype, mode="r", offset=FRAME_HEADER_SIZE, shape=(count,))
+  else:
+    data = numpy.empty((0,), dtype=dtype)
+  millis = data["millis"] if header.millis else None
+  return Frames(header.numlights, header.interval, millis, data["pixels"])
+
+def scale_row(row, scale):
+  """Returns a row of pixels as bytes with each pixel repeated scale times."""
+  return b"".join(p * scale for p in row)
+
+class PPMWriter:
+  """Writes each frame as a separate binary PPM file.
+
+  out.ppm is written as out_000000.ppm, out_000001.ppm, etc.
+  """
+  coalesce = False
+
+  def __init__(self, path, width, height, scale):
+    self.base = os.path.splitext(path)[0]
+    self.header = b"P6\n%d %d\n255\n" % (width*scale, height*scale)
+    self.scale = scale
+    self.frames = 0
+
+  def add(self, rows, delay):
+    with open(f"{self.base}_{self.frames:06d}.ppm", "wb") as f:
+      f.write(self.header)
+      for row in rows:
+        f.write(scale_row(row, self.scale) * self.scale)
+    self.frames += 1
+
+  def close(self):
+    pass
+
+class APNGWriter:
+  """Writes an animated PNG one frame at a time."""
+  coalesce = True
+
+  def __init__(self, path, width, height, scale):
+    self.f = open(path, "wb")
+    self.width = width*scale
+    self.height = height*scale
+    self.scale = scale
+    self.frames = 0
+    self.sequence = 0
+    self.f.write(b"\x89PNG\r\n\x1a\n")
+    self.chunk(b"IHDR", struct.pack(">IIBBBBB", self.width, self.height, 8, 2, 0, 0, 0))
+    # The number of frames is only known at the end.
+    self.actl = self.f.tell()
+    self.chunk(b"acTL", struct.pack(">II", 0, 0))
+
+  def chunk(self, kind, data):
+    self.f.write(
+        struct.pack(">I", len(data)) + kind + data +
+        struct.pack(">I", zlib.crc32(kind + data)))
+
+  # The delay of a frame is an uint16 in ms.
+  MAX_DELAY = 0xFFFF
+
+  def add(self, rows, delay):
+    # Each scanline starts with the filter type, 0 for none.
+    data = zlib.compress(b"".join(
+        (b"\0" + scale_row(row, self.scale)) * self.scale for row in rows))
+    while True:
+      # Longer delays are split across copies of the frame.
+      part = min(delay, self.MAX_DELAY)
+      self.chunk(b"fcTL", struct.pack(
+          ">IIIIIHHBB", self.sequence, self.width, self.height, 0, 0, part, 1000, 0, 0))
+      self.sequence += 1
+      if self.frames:
+        self.chunk(b"fdAT", struct.pack(">I", self.sequence) + data)
+        self.sequence += 1
+      else:
+        self.chunk(b"IDAT", data)
+      self.frames += 1
+      delay -= part
+      if not delay:
+        break
+
+  def close(self):
+    self.chunk(b"IEND", b"")
+    self.f.seek(self.actl)
+    self.chunk(b"acTL", struct.pack(">II", self.frames, 0))
+    self.f.close()
+
+def lzw_encode(data, min_size):
+  """Returns the GIF flavor of LZW compression of data."""
+  clear = 1 << min_size
+  size = min_size + 1
+  codes = {}
+  next_code = clear + 2
+  out = bytearray()
+  bits = clear
+  nbits = size
+  prefix = data[0]
+  for c in data[1:]:
+    key = (prefix << 8) | c
+    code = codes.get(key)
+    if code is not None:
+      prefix = code
+      continue
+    bits |= prefix << nbits
+    nbits += size
+    if next_code < 4096:
+      codes[key] = next_code
+      next_code += 1
+      if next_code > (1 << size) and size < 12:
+        size += 1
+    else:
+      bits |= clear << nbits
+      nbits += size
+      codes = {}
+      next_code = clear + 2
+      size = min_size + 1
+    while nbits >= 8:
+      out.append(bits & 0xFF)
+      bits >>= 8
+      nbits -= 8
+    prefix = c
+  bits |= prefix << nbits
+  nbits += size
+  bits |= (clear + 1) << nbits
+  nbits += size
+  while nbits > 0:
+    out.append(bits & 0xFF)
+    bits >>= 8
+    nbits -= 8
+  return bytes(out)
+
+class GIFWriter:
+  """Writes an animated GIF one frame at a time.
+
+  Each frame has its own palette of the colors of the LEDs, quantized to 3-3-2
+  bits when there are more than 256.
+  """
+  coalesce = True
+
+  def __init__(self, path, width, height, scale):
+    self.f = open(path, "wb")
+    self.width = width*scale
+    self.height = height*scale
+    self.scale = scale
+    # Delays are in 1/100th of a second; keep track of the rounding.
+    self.millis = 0
+    self.f.write(b"GIF89a" + struct.pack("<HHBBB", self.width, self.height, 0, 0, 0))
+    # Loop forever.
+    self.f.write(b"\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00")
+
+  def add(self, rows, delay):
+    palette = {}
+    for row in rows:
+      for p in row:
+        if p not in palette:
+          palette[p] = len(palette)
+    if len(palette) > 256:
+      palette = {p: (p[0] & 0xE0) | ((p[1] >> 3) & 0x1C) | (p[2] >> 6) for row in rows for p in row}
+      colors = [bytes((i & 0xE0, (i << 3) & 0xE0, (i << 6) & 0xC0)) for i in range(256)]
+    else:
+      colors = list(palette)
+    depth = max((len(colors)-1).bit_length(), 1)
+    colors += [b"\0\0\0"] * ((1 << depth) - len(colors))
+    centis = (self.millis + delay + 5) // 10 - (self.millis + 5) // 10
+    self.millis += delay
+    # Graphic control extension then image descriptor with a local palette.
+    self.f.write(b"\x21\xf9\x04\x00" + struct.pack("<H", centis) + b"\x00\x00")
+    self.f.write(b"\x2c" + struct.pack("<HHHHB", 0, 0, self.width, self.height, 0x80 | (depth-1)))
+    self.f.write(b"".join(colors))
+    indices = b"".join(
+        scale_row([bytes((palette[p],)) for p in row], self.scale) * self.scale for row in rows)
+    min_size = max(depth, 2)
+    data = lzw_encode(indices, min_size)
+    self.f.write(bytes((min_size,)))
+    for i in range(0, len(data), 255):
+      block = data[i:i+255]
+      self.f.write(bytes((len(block),)) + block)
+    self.f.write(b"\0")
+
+  def close(self):
+    self.f.write(b"\x3b")
+    self.f.close()
+
+# Encoders supported by --export, by file extension.
+WRITERS = {
+    ".apng": APNGWriter,
+    ".gif": GIFWriter,
+    ".png": APNGWriter,
+    ".ppm": PPMWriter,
+}
+
 def escape(r):
   return r.replace("\\", "\\\\").replace("\"", "\\\"")
 
-class Thread(threading.Thread):
-  def __init__(self, **kwargs):
-    self.returned = None
-    oldtarget = kwargs.pop("target")
-    def hook(*args, **kwargs):
-      self.returned = oldtarget(*args, **kwargs)
-    super().__init__(target=hook, **kwargs)
-
-def generate_effect(
-    esphome, outdir,
-    min_interval, one_per_line, as_hex, show_millis, once,
-    componentname, numlights, effectname, interval, code):
-  exe = os.path.join(outdir, effectname.translate(str.maketrans({x: "_" for x in " []{}\\/^$*?"})))
-  print("Compiling effect \"%s/%s\" to %s " % (componentname, effectname, exe))
-  if not interval:
-    interval = 50
-  elif interval.endswith("ms"):
-    interval = int(interval[:-2])
-  elif interval.endswith("s"):
-    interval = int(interval[:-1]) * 1000
-  else:
-    print(f"Unknown interval {interval}", file=sys.stderr)
-    return False
-  interval = max(min_interval, interval)
+def safe_name(name):
+  return name.translate(str.maketrans({x: "_" for x in " []{}\\/^$*?"}))
+
+def effect_path(outdir, effect):
+  return os.path.join(outdir, safe_name(effect.name))
+
+def combined_path(outdir, filename):
+  """Returns the path of the --combined executable for a yaml file."""
+  return os.path.join(outdir, safe_name(os.path.basename(filename).rsplit(".", 1)[0]))
+
+def effect_interval(effect, min_interval=0):
+  """Returns the update interval of the effect in ms, at least min_interval."""
+  interval = parse_duration(effect.interval) if effect.interval else 50
+  return max(min_interval, interval, 1)
+
+def effect_config(opts, effect):
+  """Returns the constants of the C++ harness that depend on the effect."""
+  interval = effect_interval(effect, opts.interval)
+  frames = opts.frames
+  if opts.duration:
+    frames = -(-opts.duration // interval)
+  layout = effect.layout
+  return {
+      "FRAMES": int(frames),
+      "INTERVAL": interval,
+      "MATRIX_HEIGHT": layout.height if layout else 0,
+      "MATRIX_WIDTH": layout.width if layout else 0,
+      "NUMLIGHTS": int(effect.numlights),
+      "SERPENTINE": bool(layout and layout.serpentine),
+  }
+
+def cpp_value(value):
+  """Returns the C++ type and literal of a python value."""
+  if isinstance(value, bool):
+    return "bool", str(value).lower()
+  return "int", str(value)
+
+def write_lambda(f, effect):
+  """Writes the update() function running the lambda of an effect."""
+  f.write(PREAMBLE)
+  f.write(textwrap.indent(effect.code.rstrip(), "  "))
+  f.write(LAMBDA_END)
+
+def write_pixel_map(f, effect):
+  """Writes the pixel_map() function of the layout of an effect."""
+  mapper = "return y*MATRIX_WIDTH + ((SERPENTINE && (y & 1)) ? MATRIX_WIDTH-1-x : x);"
+  if effect.layout and effect.layout.mapper:
+    mapper = effect.layout.mapper
+  f.write(PIXEL_MAP)
+  f.write(textwrap.indent(mapper.rstrip(), "  "))
+  f.write("\n}\n")
+
+def generate_source(opts, effects, path, kind="exe"):
+  """Writes the C++ source for a list of effects.
+
+  kind is "exe" for a standalone executable of the only effect, "combined" for
+  an executable containing all the effects selected at runtime, "host" for the
+  --watch executable that loads the lambda dynamically and "shared" for the
+  --watch shared object containing only the lambda.
+  """
+  configs = [effect_config(opts, e) for e in effects]
+  paced = not (opts.once or any(c["FRAMES"] for c in configs))
+  virtual_clock = not paced or bool(opts.seek or opts.checkpoint or opts.resume)
+  # The sentinel avoids an empty array.
+  checkpoints = ", ".join(str(c) for c in sorted(opts.checkpoint or []) + [0xFFFFFFFF])
   injected = (
       f"// Configuration\n" +
-      f"const bool AS_HEX = {str(as_hex).lower()};\n" +
-      f"const int INTERVAL = {interval};\n"
-      f"const int NUMLIGHTS = {int(numlights)};\n"
-      f"const bool ONCE = {str(once).lower()};\n" +
-      f"const bool ONE_PER_LINE = {str(one_per_line).lower()};\n" +
-      f"const bool SHOW_MILLIS = {str(show_millis).lower()};\n")
-  if once:
-    injected += "#define millis() 42\n"
-  with open(exe+".cc", "wt") as f:
+      f"const bool AS_BINARY = {str(opts.as_binary).lower()};\n" +
+      f"const bool AS_HEX = {str(opts.as_hex).lower()};\n" +
+      f"const char CHECKPOINT_PREFIX[] = \"{escape(os.path.abspath(path[:-3]))}\";\n" +
+      f"const uint32_t CHECKPOINTS[] = {{{checkpoints}}};\n" +
+      f"const uint16_t FRAME_VERSION = {FRAME_VERSION};\n" +
+      f"const int MCU_MHZ = {opts.mcu_mhz};\n"
+      f"const double MCU_SLOWDOWN = {float(opts.mcu_slowdown)!r};\n"
+      f"const bool ONCE = {str(opts.once).lower()};\n" +
+      f"const bool ONE_PER_LINE = {str(opts.one_per_line).lower()};\n" +
+      f"const bool PACED = {str(paced).lower()};\n" +
+      f"const bool PROFILE = {str(opts.profile).lower()};\n" +
+      f"const uint32_t SEEK = {opts.seek or 0};\n" +
+      f"const bool SHOW_MILLIS = {str(opts.show_millis).lower()};\n" +
+      f"const uint16_t SNAPSHOT_VERSION = {SNAPSHOT_VERSION};\n" +
+      f"const bool TRACK_HEAP = {str(opts.track_heap).lower()};\n" +
+      f"const bool VIRTUAL_CLOCK = {str(virtual_clock).lower()};\n" +
+      f"uint32_t g_virtual_millis = 42;\n")
+  # They are set by select_effect() when combined.
+  qualifier = "" if kind == "combined" else "const "
+  for name, value in configs[0].items():
+    t, v = cpp_value(value)
+    injected += f"{qualifier}{t} {name} = {v};\n"
+  if virtual_clock:
+    injected += "#define millis() g_virtual_millis\n"
+  with open(path, "wt") as f:
     f.write(HEADER)
     f.write(injected)
-    f.write(PREAMBLE)
-    f.write(textwrap.indent(code.rstrip(), "  "))
+    if kind == "shared":
+      write_lambda(f, effects[0])
+      f.write(WATCH_EFFECT)
+      return
+    if kind == "combined":
+      for i, effect in enumerate(effects):
+        f.write(f"\n// \"{escape(effect.component)}/{escape(effect.name)}\"\n")
+        f.write(f"namespace effect{i} {{\n")
+        write_lambda(f, effect)
+        write_pixel_map(f, effect)
+        f.write(f"}}  // namespace effect{i}\n")
+      f.write(COMBINED)
+      f.write("const EffectInfo EFFECTS[] = {\n")
+      for i, (effect, config) in enumerate(zip(effects, configs)):
+        values = ", ".join(cpp_value(v)[1] for v in config.values())
+        f.write(f"  {{\"{escape(effect.name)}\", effect{i}::update, effect{i}::pixel_map, {values}}},\n")
+      f.write("};\n")
+      f.write(COMBINED_SELECT)
+    else:
+      if kind == "host":
+        f.write(WATCH_HOST)
+      else:
+        write_lambda(f, effects[0])
+      write_pixel_map(f, effects[0])
     f.write(FOOTER)
     if sys.platform == "win32":
       f.write("  SetConsoleOutputCP(CP_UTF8);\n")
+      if opts.as_binary:
+        f.write("  _setmode(_fileno(stdout), _O_BINARY);\n")
+    if kind == "combined":
+      f.write("  parse_args();\n")
+    if opts.resume:
+      f.write(f"  if (!load_snapshot(\"{escape(os.path.abspath(opts.resume))}\")) {{\n")
+      f.write("    exit(1);\n")
+      f.write("  }\n")
     f.write(END)
-  # We need to inject a little bit of code.
-  files = [
-      exe+".cc",
-      os.path.join(esphome, "esphome/components/host/core.cpp"),
-      os.path.join(esphome, "esphome/components/host/preferences.cpp"),
-      os.path.join(esphome, "esphome/components/light/addressable_light.cpp"),
-      os.path.join(esphome, "esphome/components/light/esp_color_correction.cpp"),
-      os.path.join(esphome, "esphome/components/light/esp_hsv_color.cpp"),
-      os.path.join(esphome, "esphome/components/light/esp_range_view.cpp"),
-      os.path.join(esphome, "esphome/components/light/light_call.cpp"),
-      os.path.join(esphome, "esphome/components/light/light_output.cpp"),
-      os.path.join(esphome, "esphome/components/light/light_state.cpp"),
-      os.path.join(esphome, "esphome/core/application.cpp"),
-      os.path.join(esphome, "esphome/core/color.cpp"),
-      os.path.join(esphome, "esphome/core/component.cpp"),
-      os.path.join(esphome, "esphome/core/entity_base.cpp"),
-      os.path.join(esphome, "esphome/core/helpers.cpp"),
-      os.path.join(esphome, "esphome/core/scheduler.cpp"),
-  ]
+    if kind == "combined":
+      f.write(COMBINED_MAIN)
+    if opts.track_heap:
+      f.write(HEAP_HOOKS)
+
+def generate_effect(opts, support, effect):
+  exe = effect_path(opts.outdir, effect)
+  print("Compiling effect \"%s/%s\" to %s " % (effect.component, effect.name, exe))
+  generate_source(opts, [effect], exe+".cc")
+  # The esphome support code is compiled once and cached; only the generated
+  # source is compiled here.
+  subprocess.check_call(
+      [CXX] + CXXFLAGS + ["-o", exe, "-I" + opts.esphome, exe+".cc"] +
+      support.cflags + support.objs)
+  print(f"Run \"{exe}\" or \"gdb {exe}\" to diagnose a crash")
+
+def generate_combined(opts, support, effects, exe):
+  """Compiles all the effects in one executable selecting them at runtime."""
+  print("Compiling %d effects to %s" % (len(effects), exe))
+  generate_source(opts, effects, exe+".cc", "combined")
+  subprocess.check_call(
+      [CXX] + CXXFLAGS + ["-o", exe, "-I" + opts.esphome, exe+".cc"] +
+      support.cflags + support.objs)
+  print(f"Run \"{exe} --list\" to list the effects, \"{exe} <effect>\" to run one or "
+        f"\"{exe} --cycle 10\" to cycle through them")
+
+def find_effects(filename, data):
+  """Yields the addressable_lambda Effect in the parsed yaml data.
+
+  The layout of a light is taken from an addressable_light display using it.
+  """
+  layouts = {}
+  for display in data.get("display", []):
+    if display.get("platform") == "addressable_light":
+      layouts[display.get("addressable_light_id")] = Layout(
+          int(display["width"]), int(display["height"]), False,
+          display.get("pixel_mapper"))
+  for component in data.get("light", []):
+    for effectentry in component.get("effects", []):
+      for effecttype, effectdata in effectentry.items():
+        if effecttype != "addressable_lambda":
+          continue
+        componentname = component.get("name") or os.path.basename(filename).rsplit(".", 2)[0]
+        yield Effect(
+            componentname,
+            effectdata.get("name") or componentname,
+            component.get("num_leds", 70),
+            effectdata.get("update_interval", "100ms"),
+            effectdata["lambda"],
+            layouts.get(component.get("id")))
+
+def load_effects(filename, effect=None, num_leds=0, matrix=None, serpentine=False):
+  """Returns the effects in the yaml file, only the one named effect if set.
+
+  num_leds overrides the number of LEDs of every effect. matrix, a (width,
+  height) tuple, overrides the layout and serpentine applies to layouts without
+  pixel_mapper.
+  """
+  with open(filename) as f:
+    # Use BaseLoader to not have to resolve !include.
+    data = yaml.load(f, Loader=yaml.BaseLoader)
+  effects = list(find_effects(filename, data))
+  if effect:
+    names = [e.name for e in effects]
+    effects = [e for e in effects if e.name == effect]
+    if not effects:
+      raise ValueError(
+          f"No effect named \"{effect}\" in {filename}; available: " +
+          ", ".join(f"\"{n}\"" for n in names))
+  if num_leds:
+    effects = [e._replace(numlights=num_leds) for e in effects]
+  if matrix:
+    width, height = matrix
+    effects = [e._replace(layout=Layout(width, height, False, None)) for e in effects]
+  if serpentine:
+    effects = [
+        e._replace(layout=e.layout._replace(serpentine=True)) if e.layout else e
+        for e in effects
+    ]
+  return effects
+
+def build_watch_host(opts, support, effect, exe):
+  generate_source(opts, [effect], exe+".cc", "host")
+  # -rdynamic exports the esphome code to the shared object.
+  subprocess.check_call(
+      [CXX] + CXXFLAGS + ["-rdynamic", "-o", exe, "-I" + opts.esphome, exe+".cc"] +
+      support.cflags + support.objs + ["-ldl"])
+
+def build_watch_effect(opts, support, effect, so):
+  generate_source(opts, [effect], so+".cc", "shared")
+  cmd = (
+      [CXX] + CXXFLAGS +
+      ["-shared", "-fPIC", "-fvisibility=hidden", "-o", so, "-I" + opts.esphome, so+".cc"] +
+      support.cflags)
+  if sys.platform == "darwin":
+    # Symbols are resolved from the host executable when loaded.
+    cmd += ["-undefined", "dynamic_lookup"]
+  subprocess.check_call(cmd)
+
+def watch(opts, support, filename):
+  """Runs one effect and hot reloads its lambda when the yaml file changes.
+
+  Only the lambda is rebuilt, as a shared object that the running host
+  executable swaps in between two frames. The host is rebuilt and restarted
+  only when the number of LEDs or the interval changes.
+  """
+  if sys.platform == "win32":
+    print("--watch is not supported on Windows", file=sys.stderr)
+    return 1
+  mtime = None
+  current = None
+  proc = None
+  previous = None
+  generation = 0
+
+  def redraw():
+    # Makes the running host draw its next frame in full after a message.
+    if proc and proc.poll() is None:
+      proc.stdin.write(b"\n")
+      proc.stdin.flush()
+
   try:
-    subprocess.check_call(["g++", "-std=c++17", "-ggdb", "-o", exe, "-DUSE_HOST", "-I.", "-I" + esphome] + files)
+    while True:
+      try:
+        st = os.stat(filename).st_mtime_ns
+      except OSError:
+        # Editors saving by rename briefly remove the file.
+        time.sleep(0.1)
+        continue
+      if st == mtime:
+        time.sleep(0.1)
+        continue
+      mtime = st
+      try:
+        effects = load_effects(
+            filename, effect=opts.effect, num_leds=opts.num_leds,
+            matrix=opts.matrix, serpentine=opts.serpentine)
+      except (yaml.YAMLError, KeyError, ValueError) as e:
+        print(f"\nFailed to parse {filename}: {e}", file=sys.stderr)
+        redraw()
+        continue
+      if not effects:
+        print(f"\nNo effect found in {filename}", file=sys.stderr)
+        redraw()
+        continue
+      effect = effects[0]
+      if effect == current and proc.poll() is None:
+        continue
+      start = time.monotonic()
+      restart = (
+          not current or proc.poll() is not None or
+          (effect.numlights, effect.interval, effect.layout) !=
+          (current.numlights, current.interval, current.layout))
+      base = effect_path(opts.outdir, effect)
+      generation += 1
+      so = f"{base}.{generation}.so"
+      try:
+        if restart:
+          build_watch_host(opts, support, effect, base)
+        build_watch_effect(opts, support, effect, so)
+      except (subprocess.CalledProcessError, ValueError) as e:
+        print(f"\nCompilation failed: {e}", file=sys.stderr)
+        redraw()
+        continue
+      if restart:
+        if proc:
+          proc.terminate()
+          proc.wait()
+        proc = subprocess.Popen([base], stdin=subprocess.PIPE)
+      # Print before reloading, which redraws the whole frame.
+      print(f"\nLoaded \"{effect.name}\" in {time.monotonic()-start:.2f}s", file=sys.stderr)
+      # dlopen() caches by path so each generation has its own file.
+      proc.stdin.write(os.path.abspath(so).encode() + b"\n")
+      proc.stdin.flush()
+      if previous:
+        os.remove(previous)
+        os.remove(previous+".cc")
+      previous = so
+      current = effect
+  except KeyboardInterrupt:
+    pass
+  finally:
+    if proc:
+      proc.terminate()
+      proc.wait()
+    if previous:
+      os.remove(previous)
+      os.remove(previous+".cc")
+  return 0
+
+def export(opts, support, filename):
+  """Renders the effect on the virtual clock into the --export animation file.
+
+  The frames are streamed from the emulator to the encoder, so the memory use
+  does not depend on the length of the animation.
+  """
+  effects = load_effects(
+      filename, effect=opts.effect, num_leds=opts.num_leds, matrix=opts.matrix,
+      serpentine=opts.serpentine)
+  if not effects:
+    print(f"No effect found in {filename}", file=sys.stderr)
+    return 1
+  effect = effects[0]
+  writer_class = WRITERS[os.path.splitext(opts.export)[1].lower()]
+  opts = argparse.Namespace(**vars(opts))
+  opts.as_binary = True
+  opts.as_hex = False
+  opts.show_millis = False
+  exe = effect_path(opts.outdir, effect)
+  try:
+    generate_effect(opts, support, effect)
+    out = subprocess.check_output(
+        [exe], env=dict(os.environ, ELLEE_PIXEL_MAP="1"), text=True)
   except subprocess.CalledProcessError as e:
-    print("Compilation failed:", e, file=sys.stderr)
-    return False
-  print(f"Run \"{exe}\" or \"gdb {exe}\" to diagnose a crash")
-  return True
-
-def parse_light(esphome, outdir, min_interval, one_per_line, as_hex,
-                show_millis, once, filename, component):
-  if "effects" not in component:
-    return True
-  threads = []
-  for effectentry in component["effects"]:
-    for effecttype, effectdata in effectentry.items():
-      if effecttype != "addressable_lambda":
+    print("Failed:", e, file=sys.stderr)
+    return 1
+  mapping = [[int(i) for i in line.split()] for line in out.splitlines()]
+  config = effect_config(opts, effect)
+  interval = config["INTERVAL"]
+  expected = 1 if opts.once else config["FRAMES"]
+  start = time.monotonic()
+  proc = subprocess.Popen([exe], stdout=subprocess.PIPE)
+  try:
+    try:
+      header = parse_frame_header(proc.stdout.read(FRAME_HEADER_SIZE))
+    except ValueError:
+      print(f"\"{effect.name}\" did not render any frame", file=sys.stderr)
+      return 1
+    numlights = header.numlights
+    black = b"\0\0\0"
+    def image(data):
+      leds = [data[3*i:3*i+3] for i in range(numlights)]
+      return [[leds[i] if 0 <= i < numlights else black for i in row] for row in mapping]
+    writer = writer_class(opts.export, len(mapping[0]), len(mapping), opts.export_scale)
+    frames = 0
+    pending = None
+    delay = 0
+    while True:
+      data = proc.stdout.read(header.size)
+      if len(data) < header.size:
+        break
+      frames += 1
+      # Identical frames are merged by extending the delay of the previous one.
+      if writer.coalesce and data == pending and delay < 60000:
+        delay += interval
         continue
-      componentname = component.get("name") or os.path.basename(filename).rsplit(".", 2)[0]
-      effeectname = effectdata.get("name") or componentname
-      t = Thread(
-          target=generate_effect,
-          args=(
-              esphome, outdir,
-              min_interval, one_per_line, as_hex, show_millis, once,
-              componentname, component.get("num_leds", 70),
-              effeectname,
-              effectdata.get("update_interval", "100ms"),
-              effectdata["lambda"]))
-      t.start()
-      threads.append(t)
-  for t in threads:
-    t.join()
-  return min(t.returned for t in threads) if threads else True
+      if pending is not None:
+        writer.add(image(pending), delay)
+      pending = data
+      delay = interval
+    if pending is not None:
+      writer.add(image(pending), delay)
+    writer.close()
+  finally:
+    proc.stdout.close()
+    proc.wait()
+  if proc.returncode or frames < expected:
+    # The animation was written but is truncated.
+    print(
+        f"Failed: \"{effect.name}\" exited with {proc.returncode} after {frames} "
+        f"of {expected} frames", file=sys.stderr)
+    return 1
+  print(f"Exported {frames} frames to {opts.export} in {time.monotonic()-start:.2f}s")
+  return 0
 
 def main():
   # TODO(maruel): Make it nice for Windows and macOS users.
-  if not shutil.which("g++"):
+  if not shutil.which(CXX):
     print("Install g++ first", file=sys.stderr)
     return 1
   esphomekwargs = {"required": True}
@@ -243,6 +2025,16 @@ def main():
   parser.add_argument(
       "--outdir", default=".", metavar=".",
       help="Directory to store generated source and executabe")
+  parser.add_argument(
+      "--cache-dir", default=default_cache_dir(), metavar="path",
+      help="Directory to cache the compiled esphome support code")
+  parser.add_argument(
+      "-j", "--jobs", type=int, default=os.cpu_count() or 1, metavar="N",
+      help="Number of concurrent compilations; default: %(default)s")
+  parser.add_argument(
+      "--order", choices=("fifo", "longest"), default="fifo",
+      help="Order to start compilations; longest starts the biggest effects "
+           "first")
   parser.add_argument(
       "--interval", type=int, default=0, help="Minimal interval in ms to use")
   parser.add_argument(
@@ -251,29 +2043,142 @@ def main():
   parser.add_argument(
       "--as-hex", action="store_true",
       help="Display hex values instead of using ANSI colors")
+  parser.add_argument(
+      "--as-binary", action="store_true",
+      help="Write a binary frame stream instead of text, to be redirected to "
+           "a file or a pipe; see read_frames()")
   parser.add_argument(
       "--one-per-line", action="store_true",
       help="Draw each update on a new line")
   parser.add_argument(
       "--once", action="store_true",
       help="Draw one update then exit")
+  parser.add_argument(
+      "--frames", type=int, default=0, metavar="N",
+      help="Draw N updates on a virtual clock as fast as possible then exit")
+  parser.add_argument(
+      "--duration", metavar="30s",
+      help="Like --frames but expressed as a duration of the animation")
+  parser.add_argument(
+      "--seek", metavar="45min",
+      help="Compute the animation up to this time without rendering it, on a "
+           "virtual clock")
+  parser.add_argument(
+      "--checkpoint", metavar="10min,45min",
+      help="Save a snapshot of the LEDs, their effect data and the clock at "
+           "these times, to <executable>.<ms>.snap")
+  parser.add_argument(
+      "--resume", metavar="file.snap",
+      help="Start from a snapshot saved with --checkpoint")
+  parser.add_argument(
+      "--profile", action="store_true",
+      help="Measure each update() call and print statistics on exit; send "
+           "SIGUSR1 to print them while running")
+  parser.add_argument(
+      "--optimize", action="store_true",
+      help="Compile with optimizations, for --profile measurements closer to "
+           "the target's optimized build")
+  parser.add_argument(
+      "--mcu-slowdown", type=float, default=1., metavar="F",
+      help="How much slower the target runs the lambda compared to this "
+           "computer, to project --profile results; default: %(default)s")
+  parser.add_argument(
+      "--mcu-mhz", type=int, default=240, metavar="MHZ",
+      help="Target CPU frequency to project --profile results in cycles; "
+           "default: %(default)s")
+  parser.add_argument(
+      "--track-heap", action="store_true",
+      help="Track the heap allocations and stack usage of update() and print "
+           "statistics on exit; frames allocating after the initial run are "
+           "reported")
+  parser.add_argument(
+      "--num-leds", type=int, default=0, metavar="N",
+      help="Override num_leds of every light")
+  parser.add_argument(
+      "--matrix", type=parse_matrix, metavar="WxH",
+      help="Render the LEDs as a 2D matrix; by default it is read from an "
+           "addressable_light display in the yaml file")
+  parser.add_argument(
+      "--serpentine", action="store_true",
+      help="Every other row of the matrix is wired in reverse")
+  parser.add_argument(
+      "--effect", metavar="NAME",
+      help="Only build the effect with this name")
+  parser.add_argument(
+      "--combined", action="store_true",
+      help="Build one executable for all the effects, selected at runtime")
+  parser.add_argument(
+      "--export", metavar="out.gif",
+      help="Render --frames or --duration of the first effect to an animated "
+           "GIF, an APNG (.png or .apng) or a PPM file per frame (.ppm)")
+  parser.add_argument(
+      "--export-scale", type=int, default=8, metavar="N",
+      help="Size in pixels of each LED with --export; default: %(default)s")
+  parser.add_argument(
+      "--watch", action="store_true",
+      help="Run the effect and reload it live when the yaml file is modified")
   args = parser.parse_args()
+  try:
+    if args.duration:
+      args.duration = parse_duration(args.duration)
+    if args.seek:
+      args.seek = parse_duration(args.seek)
+    if args.checkpoint:
+      args.checkpoint = [parse_duration(c) for c in args.checkpoint.split(",")]
+  except ValueError as e:
+    parser.error(str(e))
+  if args.resume and not os.path.isfile(args.resume):
+    parser.error(f"{args.resume} does not exist")
+  if args.watch and (args.once or args.frames or args.duration):
+    parser.error("--watch cannot be used with --once, --frames or --duration")
+  if args.watch and (args.seek or args.checkpoint or args.resume):
+    # The reloaded lambda would not see the virtual clock of the host.
+    parser.error("--watch cannot be used with --seek, --checkpoint or --resume")
+  if args.watch and args.combined:
+    parser.error("--watch cannot be used with --combined")
+  if args.export:
+    if os.path.splitext(args.export)[1].lower() not in WRITERS:
+      parser.error(f"--export supports {', '.join(sorted(WRITERS))} files")
+    if not (args.once or args.frames or args.duration):
+      parser.error("--export requires --once, --frames or --duration")
+    if args.watch or args.combined:
+      parser.error("--export cannot be used with --watch or --combined")
+    if args.export_scale < 1:
+      parser.error("--export-scale must be at least 1")
   if not os.path.isfile(os.path.join(args.esphome, "esphome", "core", "color.cpp")):
     print("--esphome must point to a checkout of https://github.com/esphome/esphome", file=sys.stderr)
     return 1
-  # Use BaseLoader to not have to resolve !include.
-  data = yaml.load(args.file, Loader=yaml.BaseLoader)
-  threads = []
-  for item in data.get("light", []):
-    t = Thread(
-        target=parse_light,
-        args=(args.esphome, args.outdir, args.interval, args.one_per_line,
-              args.as_hex, args.show_millis, args.once, args.file.name, item))
-    t.start()
-    threads.append(t)
-  for t in threads:
-    t.join()
-  return int(not (min(t.returned for t in threads) if threads else True))
+  args.file.close()
+  try:
+    effects = load_effects(
+        args.file.name, effect=args.effect, num_leds=args.num_leds,
+        matrix=args.matrix, serpentine=args.serpentine)
+  except ValueError as e:
+    print(e, file=sys.stderr)
+    return 1
+  if not effects and not args.watch:
+    print(f"No effect found in {args.file.name}", file=sys.stderr)
+    return 1
+  scheduler = Scheduler(args.jobs, args.order)
+  support = build_support(args.esphome, args.cache_dir, scheduler, args.optimize)
+  if not support:
+    return 1
+  if args.watch:
+    return watch(args, support, args.file.name)
+  if args.export:
+    return export(args, support, args.file.name)
+  if args.combined:
+    exe = combined_path(args.outdir, args.file.name)
+    jobs = [
+        Job(os.path.basename(exe), generate_combined, (args, support, effects, exe),
+            sum(len(e.code) for e in effects))
+    ]
+  else:
+    jobs = [
+        Job(f"{e.component}/{e.name}", generate_effect, (args, support, e), len(e.code))
+        for e in effects
+    ]
+  return int(not scheduler.run(jobs))
 
 if __name__ == "__main__":
   sys.exit(main())
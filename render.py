@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# Copyright 2024 Marc-Antoine Ruel. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Renders a long animation of a stateless effect in parallel.
+
+The effect is compiled once then the time range is split in shards, each
+rendered by its own emulator process starting at its own virtual clock offset.
+The binary frame streams are stitched back in order into one stream readable
+with ellee.read_frames().
+
+This is only valid for effects that are a pure function of millis() and the LED
+index. Use --check to verify it: each shard then renders a few more frames that
+must match the first frames of the next shard, which started from scratch.
+"""
+
+import argparse
+import concurrent.futures
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+import ellee
+
+def render_shard(exe, offset, path):
+  """Runs exe with its clock starting offset ms later, writing to path."""
+  env = dict(os.environ, ELLEE_OFFSET=str(offset))
+  with open(path, "wb") as f:
+    subprocess.run([exe], stdout=f, env=env, check=True)
+
+def frame_size(path):
+  """Returns the size of a frame in the stream at path."""
+  with open(path, "rb") as f:
+    try:
+      return ellee.parse_frame_header(f.read(ellee.FRAME_HEADER_SIZE)).size
+    except ValueError as e:
+      raise ValueError(f"{path}: {e}")
+
+def read_raw_frames(path, size, first, count):
+  """Returns count raw frames of the stream at path starting at first."""
+  with open(path, "rb") as f:
+    f.seek(ellee.FRAME_HEADER_SIZE + first*size)
+    return f.read(count*size)
+
+def check(paths, size, shard, overlap, interval):
+  """Returns a message if the overlapping frames of two shards differ."""
+  for i in range(len(paths) - 1):
+    seq = read_raw_frames(paths[i], size, shard, overlap)
+    fresh = read_raw_frames(paths[i+1], size, 0, overlap)
+    for j in range(min(len(seq), len(fresh)) // size):
+      if seq[j*size:(j+1)*size] != fresh[j*size:(j+1)*size]:
+        frame = (i+1)*shard + j
+        return (
+            f"frame {frame} at {frame*interval}ms differs when starting from "
+            f"scratch; the effect is not stateless")
+  return None
+
+def stitch(paths, size, shard, total, out):
+  """Concatenates the first shard frames of each stream, total frames overall."""
+  with open(out, "wb") as dst:
+    for i, path in enumerate(paths):
+      want = min(shard, total - i*shard) * size
+      with open(path, "rb") as src:
+        header = src.read(ellee.FRAME_HEADER_SIZE)
+        if not i:
+          dst.write(header)
+        while want:
+          chunk = src.read(min(want, 1 << 20))
+          if not chunk:
+            raise ValueError(f"shard {i} is truncated; did the effect exit?")
+          dst.write(chunk)
+          want -= len(chunk)
+
+def main():
+  esphomekwargs = {"required": True}
+  if os.path.isfile(os.path.join(THIS_DIR, "..", "esphome", "esphome", "core", "color.cpp")):
+    esphomekwargs = {"default": os.path.join(THIS_DIR, "..", "esphome")}
+  parser = argparse.ArgumentParser(description=sys.modules[__name__].__doc__)
+  parser.add_argument(
+      "file", metavar="file.yaml", help="esphome yaml file to render")
+  parser.add_argument(
+      "-o", "--output", required=True, metavar="out.bin",
+      help="Binary frame stream to write")
+  parser.add_argument(
+      "--duration", required=True, metavar="24h",
+      help="Duration of the animation to render")
+  parser.add_argument(
+      "--esphome", metavar="path/to/esphome.git",
+      help="Path to esphome source code", **esphomekwargs)
+  parser.add_argument(
+      "--cache-dir", default=ellee.default_cache_dir(), metavar="path",
+      help="Directory to cache the compiled esphome support code")
+  parser.add_argument(
+      "--effect", metavar="NAME",
+      help="Effect to render; default: the first one")
+  parser.add_argument(
+      "--num-leds", type=int, default=0, metavar="N",
+      help="Override num_leds of the light")
+  parser.add_argument(
+      "--show-millis", action="store_true",
+      help="Include the time of each frame in the stream")
+  parser.add_argument(
+      "-j", "--jobs", type=int, default=os.cpu_count() or 1, metavar="N",
+      help="Number of concurrent emulators; default: %(default)s")
+  parser.add_argument(
+      "--shards", type=int, default=0, metavar="N",
+      help="Number of slices to split the animation in; default: --jobs")
+  parser.add_argument(
+      "--check", type=int, nargs="?", const=10, default=0, metavar="FRAMES",
+      help="Verify the effect is stateless by rendering this many frames "
+           "twice at each shard boundary; default: %(const)s")
+  args = parser.parse_args()
+  try:
+    duration = ellee.parse_duration(args.duration)
+  except ValueError as e:
+    parser.error(str(e))
+  if duration <= 0:
+    parser.error("--duration must be positive")
+  try:
+    effects = ellee.load_effects(
+        args.file, effect=args.effect, num_leds=args.num_leds)
+  except ValueError as e:
+    print(e, file=sys.stderr)
+    return 1
+  if not effects:
+    print(f"No effect found in {args.file}", file=sys.stderr)
+    return 1
+  effect = effects[0]
+  interval = ellee.effect_interval(effect)
+  total = -(-duration // interval)
+  shards = min(args.shards or args.jobs, total)
+  shard = -(-total // shards)
+  shards = -(-total // shard)
+  tmpdir = tempfile.mkdtemp(prefix="ellee", dir=os.path.dirname(os.path.abspath(args.output)))
+  try:
+    # The executable renders a fixed number of frames; the last shard is
+    # truncated when stitching.
+    cmd = [
+        sys.executable, os.path.join(THIS_DIR, "ellee.py"), args.file,
+        "--esphome", args.esphome, "--cache-dir", args.cache_dir,
+        "--outdir", tmpdir, "--effect", effect.name,
+        "--frames", str(shard + args.check), "--as-binary",
+    ]
+    if args.num_leds:
+      cmd += ["--num-leds", str(args.num_leds)]
+    if args.show_millis:
+      cmd.append("--show-millis")
+    subprocess.check_call(cmd, stdout=subprocess.DEVNULL)
+    exe = ellee.effect_path(tmpdir, effect)
+    paths = [os.path.join(tmpdir, f"{i}.bin") for i in range(shards)]
+    print(f"Rendering {total} frames of \"{effect.name}\" in {shards} shards",
+          file=sys.stderr)
+    with concurrent.futures.ThreadPoolExecutor(args.jobs) as pool:
+      for f in [
+          pool.submit(render_shard, exe, i*shard*interval, p)
+          for i, p in enumerate(paths)]:
+        f.result()
+    size = frame_size(paths[0])
+    if args.check:
+      msg = check(paths, size, shard, args.check, interval)
+      if msg:
+        print(msg, file=sys.stderr)
+        return 1
+    stitch(paths, size, shard, total, args.output)
+  except (subprocess.CalledProcessError, ValueError) as e:
+    print("Failed:", e, file=sys.stderr)
+    return 1
+  finally:
+    shutil.rmtree(tmpdir)
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -3,17 +3,24 @@
 # Use of this source code is governed under the Apache License, Version 2.0
 # that can be found in the LICENSE file.
 
+import argparse
 import glob
+import hashlib
+import json
 import os
 import shutil
 import subprocess
+import struct
 import sys
 import tempfile
 import threading
+import zlib
 
 THIS_DIR = os.path.dirname(os.path.abspath(__file__))
 os.chdir(THIS_DIR)
 
+import ellee
+
 EXPECTATIONS = {
     "impulse.yaml": {
       "Generic_linear_multi-points_impulse": b'\r0a0a0a 232323 3b3b3b 545454 6c6c6c 858585 9d9d9d b6b6b6 cecece e7e7e7 ffffff ffffff ffffff ffffff ffffff ffffff ffffff ffffff ffffff ffffff ffffff fcfcfc f9f9f9 f7f7f7 f4f4f4 f1f1f1 eeeeee ebebeb e8e8e8 e6e6e6 e3e3e3 e0e0e0 dddddd dadada d8d8d8 d5d5d5 d2d2d2 cfcfcf cccccc cacaca c7c7c7 c4c4c4 c1c1c1 bebebe bbbbbb b9b9b9 b6b6b6 b3b3b3 b0b0b0 adadad ababab a8a8a8 a5a5a5 a2a2a2 9f9f9f 9d9d9d 9a9a9a 979797 949494 919191 8e8e8e 8c8c8c 898989 868686 838383 808080 7e7e7e 7b7b7b 787878 757575 727272 707070 6d6d6d 6a6a6a 676767 646464 616161 5f5f5f 5c5c5c 595959 565656 535353 515151 4e4e4e 4b4b4b 484848 454545 434343 404040 3d3d3d 3a3a3a 373737 343434 323232 2f2f2f 2c2c2c 292929 262626 242424 212121 1e1e1e 1e1e1e 1e1e1e 1d1d1d 1d1d1d 1d1d1d 1d1d1d 1d1d1d 1d1d1d 1c1c1c 1c1c1c 1c1c1c 1c1c1c 1c1c1c 1b1b1b 1b1b1b 1b1b1b 1b1b1b 1b1b1b 1a1a1a 1a1a1a 1a1a1a 1a1a1a 1a1a1a 1a1a1a 191919 191919 191919 191919 191919 181818 181818 181818 181818 181818 171717 171717 171717 171717 171717 171717 161616 161616 161616 161616 161616 151515 151515 151515 151515 151515 151515 141414 141414 141414 141414 141414 131313 131313 131313 131313 131313 121212 121212 121212 121212 121212 121212 111111 111111 111111 111111 111111 101010 101010 101010 101010 101010 0f0f0f 0f0f0f 0f0f0f 0f0f0f 0f0f0f 0f0f0f 0e0e0e 0e0e0e 0e0e0e 0e0e0e 0e0e0e 0d0d0d 0d0d0d 0d0d0d 0d0d0d 0d0d0d 0d0d0d 0c0c0c 0c0c0c 0c0c0c 0c0c0c 0c0c0c 0b0b0b 0b0b0b 0b0b0b 0b0b0b 0b0b0b 0a0a0a 0a0a0a 0a0a0a 0a0a0a 0a0a0a 0a0a0a 090909 090909 090909 090909 090909 080808 080808 080808 080808 080808 080808 070707 070707 070707 070707 070707 060606 060606 060606 060606 060606 050505 050505 050505 050505 050505 050505 040404 040404 040404 040404 040404 030303 030303 030303 030303 030303 020202 020202 020202 020202 020202 020202 010101 010101\n',
@@ -35,6 +42,16 @@ EXPECTATIONS = {
     },
 }
 
+# Samples not checked with --golden.
+GOLDEN_SKIP = {
+    # Exits during the first frame.
+    "printf_then_exit.yaml",
+}
+
+# Sample exported to every format and decoded back, with the number of frames.
+EXPORT_SAMPLE = "waves.yaml"
+EXPORT_FRAMES = 50
+
 class Thread(threading.Thread):
   def __init__(self, **kwargs):
     self.returned = None
@@ -92,7 +109,272 @@ def run(esphome, name, effects):
     shutil.rmtree(tmpdir)
   return True
 
+def golden_path(name):
+  """Returns the path of the digest file of a sample."""
+  return os.path.splitext(name)[0] + ".golden.json"
+
+def digests(data):
+  """Returns the digest of each frame and of each LED over all the frames of
+  a binary frame stream.
+  """
+  header = ellee.parse_frame_header(data[:ellee.FRAME_HEADER_SIZE])
+  numlights = header.numlights
+  offset = 4 if header.millis else 0
+  size = header.size
+  body = data[ellee.FRAME_HEADER_SIZE:]
+  frames = [body[i:i+size] for i in range(0, len(body)-size+1, size)]
+  return {
+      "numlights": numlights,
+      "frames": [hashlib.blake2b(f, digest_size=8).hexdigest() for f in frames],
+      "leds": [
+          hashlib.blake2b(
+              b"".join(f[offset+3*i:offset+3*i+3] for f in frames),
+              digest_size=4).hexdigest()
+          for i in range(numlights)
+      ],
+  }
+
+def compare(name, want, got):
+  """Prints the first difference between two digests() and returns False if
+  they differ.
+  """
+  if want["numlights"] != got["numlights"]:
+    print(f"{name}: {got['numlights']} LEDs instead of {want['numlights']}", file=sys.stderr)
+    return False
+  for i, (w, g) in enumerate(zip(want["frames"], got["frames"])):
+    if w != g:
+      leds = [j for j, (a, b) in enumerate(zip(want["leds"], got["leds"])) if a != b]
+      msg = f"{name}: frame {i} is the first to differ"
+      if leds:
+        msg += f", LED {leds[0]} is the first one to differ over the run"
+      print(msg, file=sys.stderr)
+      return False
+  if len(want["frames"]) != len(got["frames"]):
+    print(f"{name}: {len(got['frames'])} frames instead of {len(want['frames'])}", file=sys.stderr)
+    return False
+  return True
+def lzw_decode(data, min_size):
+  """Returns the indices of a GIF LZW compressed image."""
+  clear = 1 << min_size
+  size = min_size + 1
+  table = [bytes((i,)) for i in range(clear)] + [b"", b""]
+  out = bytearray()
+  prev = None
+  bits = 0
+  nbits = 0
+  pos = 0
+  while True:
+    while nbits < size:
+      if pos == len(data):
+        raise ValueError("truncated LZW data")
+      bits |= data[pos] << nbits
+      pos += 1
+      nbits += 8
+    code = bits & ((1 << size) - 1)
+    bits >>= size
+    nbits -= size
+    if code == clear:
+      del table[clear+2:]
+      size = min_size + 1
+      prev = None
+      continue
+    if code == clear + 1:
+      return bytes(out)
+    if code < len(table) and prev is None:
+      entry = table[code]
+    elif code < len(table):
+      entry = table[code]
+      table.append(prev + entry[:1])
+    elif code == len(table) and prev is not None:
+      entry = prev + prev[:1]
+      table.append(entry)
+    else:
+      raise ValueError(f"invalid LZW code {code}")
+    if len(table) == 1 << size and size < 12:
+      size += 1
+    out += entry
+    prev = entry
+
+def gif_frames(data):
+  """Decodes an animated GIF; returns its width and a list of (delay in ms,
+  RGB pixels) per frame.
+  """
+  if data[:6] != b"GIF89a":
+    raise ValueError("not a GIF")
+  width, _, flags = struct.unpack("<HHB", data[6:11])
+  i = 13
+  if flags & 0x80:
+    i += 3 << ((flags & 7) + 1)
+  frames = []
+  delay = 0
+  while data[i] != 0x3B:
+    if data[i] == 0x21:
+      if data[i+1] == 0xF9:
+        delay = struct.unpack("<H", data[i+4:i+6])[0] * 10
+      i += 2
+      while data[i]:
+        i += data[i] + 1
+      i += 1
+    elif data[i] == 0x2C:
+      _, _, w, h, flags = struct.unpack("<HHHHB", data[i+1:i+10])
+      i += 10
+      palette = b""
+      if flags & 0x80:
+        palette = data[i:i + (3 << ((flags & 7) + 1))]
+        i += len(palette)
+      min_size = data[i]
+      i += 1
+      compressed = bytearray()
+      while data[i]:
+        compressed += data[i+1:i+1+data[i]]
+        i += data[i] + 1
+      i += 1
+      indices = lzw_decode(compressed, min_size)
+      if len(indices) != w*h:
+        raise ValueError(f"frame {len(frames)} has {len(indices)} pixels instead of {w*h}")
+      frames.append((delay, b"".join(palette[3*c:3*c+3] for c in indices)))
+    else:
+      raise ValueError(f"unexpected GIF block 0x{data[i]:02x}")
+  return width, frames
+
+def png_frames(data):
+  """Decodes an APNG without filtering; returns its width and a list of (delay
+  in ms, RGB pixels) per frame.
+  """
+  if data[:8] != b"\x89PNG\r\n\x1a\n":
+    raise ValueError("not a PNG")
+  i = 8
+  declared = None
+  frames = []
+  kind = None
+  while kind != b"IEND":
+    n, kind = struct.unpack(">I4s", data[i:i+8])
+    body = data[i+8:i+8+n]
+    if struct.unpack(">I", data[i+8+n:i+12+n])[0] != zlib.crc32(kind + body):
+      raise ValueError(f"invalid CRC of {kind}")
+    i += 12 + n
+    if kind == b"IHDR":
+      width, height = struct.unpack(">II", body[:8])
+    elif kind == b"acTL":
+      declared = struct.unpack(">I", body[:4])[0]
+    elif kind == b"fcTL":
+      num, den = struct.unpack(">HH", body[20:24])
+      delay = num * 1000 // (den or 100)
+    elif kind in (b"IDAT", b"fdAT"):
+      raw = zlib.decompress(body if kind == b"IDAT" else body[4:])
+      stride = 1 + 3*width
+      if len(raw) != stride*height or any(raw[y*stride] for y in range(height)):
+        raise ValueError(f"frame {len(frames)} is not {width}x{height} unfiltered RGB")
+      frames.append((delay, b"".join(raw[y*stride+1:(y+1)*stride] for y in range(height))))
+  if declared != len(frames):
+    raise ValueError(f"acTL declares {declared} frames but there are {len(frames)}")
+  return width, frames
+
+def run_export(esphome, cachedir, name, frames):
+  """Exports the first effect of the sample to each animation format, decodes
+  them back and compares them with the frames rendered with --as-binary.
+  """
+  print(f"{name} --export")
+  tmpdir = tempfile.mkdtemp(prefix="elllee")
+  scale = 2
+  try:
+    cmd = [
+        sys.executable, "ellee.py", name, "--frames", str(frames), "--outdir", tmpdir,
+        "--esphome", esphome, "--cache-dir", cachedir]
+    subprocess.check_output(cmd + ["--as-binary"])
+    effect = ellee.load_effects(name)[0]
+    data = subprocess.check_output([ellee.effect_path(tmpdir, effect)])
+    header = ellee.parse_frame_header(data[:ellee.FRAME_HEADER_SIZE])
+    body = data[ellee.FRAME_HEADER_SIZE:]
+    want = [body[i:i+header.size] for i in range(0, len(body), header.size)]
+    for ext, decode in ((".gif", gif_frames), (".png", png_frames)):
+      path = os.path.join(tmpdir, "out" + ext)
+      subprocess.check_output(cmd + ["--export", path, "--export-scale", str(scale)])
+      with open(path, "rb") as f:
+        width, images = decode(f.read())
+      if width != header.numlights*scale:
+        print(f"{path} is {width} pixels wide", file=sys.stderr)
+        return False
+      # Expand the merged frames and take the top left pixel of each LED.
+      got = []
+      for delay, pixels in images:
+        leds = b"".join(pixels[3*x:3*x+3] for x in range(0, width, scale))
+        got += [leds] * (delay // header.interval)
+      if got != want:
+        frame = next((i for i, (w, g) in enumerate(zip(want, got)) if w != g), min(len(want), len(got)))
+        print(f"{path}: frame {frame} differs from --as-binary", file=sys.stderr)
+        return False
+  except (subprocess.CalledProcessError, ValueError, IndexError, struct.error, zlib.error) as e:
+    print("Failed:", e, file=sys.stderr)
+    if getattr(e, "output", None):
+      print(e.output, file=sys.stderr)
+    return False
+  finally:
+    shutil.rmtree(tmpdir)
+  return True
+
+
+def run_golden(esphome, cachedir, name, frames, update):
+  """Renders frames of every effect in the sample and compares their digests
+  with the ones stored next to it, or stores them when update is True.
+  """
+  print(name)
+  tmpdir = tempfile.mkdtemp(prefix="elllee")
+  try:
+    # Compile all the effects at once.
+    subprocess.check_output(
+        [sys.executable, "ellee.py", name, "--combined", "--frames", str(frames),
+         "--as-binary", "--show-millis", "--outdir", tmpdir, "--esphome", esphome,
+         "--cache-dir", cachedir])
+    exe = ellee.combined_path(tmpdir, name)
+    got = {"frames": frames, "effects": {}}
+    for i, effect in enumerate(ellee.load_effects(name)):
+      got["effects"][effect.name] = digests(subprocess.check_output([exe, str(i)]))
+    path = golden_path(name)
+    if update:
+      with open(path, "w") as f:
+        json.dump(got, f, indent=1, sort_keys=True)
+        f.write("\n")
+      return True
+    if not os.path.isfile(path):
+      print(f"{path} is missing; run \"test.py --golden --update\"", file=sys.stderr)
+      return False
+    with open(path) as f:
+      want = json.load(f)
+    if want["frames"] != frames:
+      print(f"{path} has {want['frames']} frames per effect, use --frames {want['frames']}", file=sys.stderr)
+      return False
+    if set(want["effects"]) != set(got["effects"]):
+      print(f"Effects in {name} do not match {path}", file=sys.stderr)
+      return False
+    ok = True
+    for effect, w in want["effects"].items():
+      ok = compare(f"{name}/{effect}", w, got["effects"][effect]) and ok
+    return ok
+  except (subprocess.CalledProcessError, ValueError) as e:
+    print("Failed:", e, file=sys.stderr)
+    if getattr(e, "output", None):
+      print(e.output, file=sys.stderr)
+    return False
+  finally:
+    shutil.rmtree(tmpdir)
+
 def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      "--esphome", default=os.path.join("..", "esphome"), metavar="path/to/esphome.git",
+      help="Path to esphome source code; default: %(default)s")
+  parser.add_argument(
+      "--golden", action="store_true",
+      help="Render --frames frames of each effect and compare their digests "
+           "with samples/*.golden.json")
+  parser.add_argument(
+      "--frames", type=int, default=200, metavar="N",
+      help="Number of frames to render with --golden; default: %(default)s")
+  parser.add_argument(
+      "--update", action="store_true",
+      help="Write samples/*.golden.json instead of comparing; implies --golden")
+  args = parser.parse_args()
   actual = set(glob.glob("samples/*.yaml"))
   expected = set(os.path.join("samples", i) for i in EXPECTATIONS)
   if actual != expected:
@@ -103,10 +385,27 @@ def main():
     if missing:
       print(f"Expectations without sample: {', '.join(missing)}", file=sys.stderr)
     return 1
-  esphome = "../esphome"
+  esphome = args.esphome
+  # Build the esphome support code once for all the samples.
+  cachedir = ellee.default_cache_dir()
+  if not ellee.build_support(esphome, cachedir, ellee.Scheduler(os.cpu_count() or 1, "fifo")):
+    return 1
   threads = []
   for sample, effects in EXPECTATIONS.items():
-    t = Thread(target=run, args=(esphome, os.path.join("samples", sample), effects))
+    if args.golden or args.update:
+      if sample in GOLDEN_SKIP:
+        continue
+      t = Thread(
+          target=run_golden,
+          args=(esphome, cachedir, os.path.join("samples", sample), args.frames, args.update))
+    else:
+      t = Thread(target=run, args=(esphome, os.path.join("samples", sample), effects))
+    t.start()
+    threads.append(t)
+  if not (args.golden or args.update):
+    t = Thread(
+        target=run_export,
+        args=(esphome, cachedir, os.path.join("samples", EXPORT_SAMPLE), EXPORT_FRAMES))
     t.start()
     threads.append(t)
   for t in threads: